@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+from argparse import ArgumentParser
+from k2phot.rolling import benchmark
+
+if __name__=="__main__":
+    p = ArgumentParser(
+        description="Time rolling_median against scipy median_filter"
+    )
+    p.add_argument(
+        '--lengths',type=float,nargs='+',default=[1e3,1e4,1e5,1e6],
+        help='lengths of the series'
+    )
+    p.add_argument(
+        '--sizes',type=int,nargs='+',default=[10,100],
+        help='window sizes'
+    )
+    args  = p.parse_args()
+    print benchmark(lengths=args.lengths, sizes=args.sizes)
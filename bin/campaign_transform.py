@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+from argparse import ArgumentParser
+from k2phot.channel_transform import campaign_transform
+
+if __name__=="__main__":
+    p = ArgumentParser(
+        description="Compute the channel transformations of a campaign"
+    )
+    p.add_argument('dbfile',type=str,help='sqlite3 database of headers')
+    p.add_argument('pixeldir',type=str,help='directory with pixel files')
+    p.add_argument('outdir',type=str,help='output directory')
+    p.add_argument(
+        '--nstars',type=int,default=50,help='number of stars per channel'
+    )
+    p.add_argument(
+        '--channels',type=int,nargs='+',default=None,
+        help='channels to process (default: all)'
+    )
+    p.add_argument(
+        '--processes',type=int,default=None,help='number of processes'
+    )
+    p.add_argument(
+        '--centroid',type=str,default='moment',choices=['moment','gaussian'],
+        help='centroid method'
+    )
+    args  = p.parse_args()
+    campaign_transform(
+        args.dbfile, args.pixeldir, args.outdir, nstars=args.nstars,
+        channels=args.channels, processes=args.processes,
+        centroid_method=args.centroid
+    )
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+from argparse import ArgumentParser
+import pandas as pd
+from k2phot.superstamp import SuperStamp
+
+if __name__=="__main__":
+    p = ArgumentParser(
+        description="Aperture photometry of every catalog star in a superstamp"
+    )
+    p.add_argument(
+        'catfile',type=str,
+        help='csv catalog with epic, ra, dec, kepmag (and optional npix)'
+    )
+    p.add_argument('outprefix',type=str,help='prefix of the output csv files')
+    p.add_argument(
+        'pixfiles',type=str,nargs='+',help='pixel files making up the mosaic'
+    )
+    p.add_argument(
+        '--tile-size',type=int,default=64,help='size of tile cores [pixels]'
+    )
+    p.add_argument(
+        '--overlap',type=int,default=8,help='tile overlap [pixels]'
+    )
+    p.add_argument(
+        '--processes',type=int,default=None,help='number of processes'
+    )
+    args  = p.parse_args()
+
+    cat = pd.read_csv(args.catfile)
+    ss = SuperStamp(args.pixfiles)
+    stars, fsap, fbg = ss.photometry(
+        cat, tile_size=args.tile_size, overlap=args.overlap,
+        processes=args.processes
+    )
+    stars.to_csv(args.outprefix + '_stars.csv', index=False)
+    fsap.to_csv(args.outprefix + '_fsap.csv')
+    fbg.to_csv(args.outprefix + '_fbg.csv')
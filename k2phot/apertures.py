@@ -1,11 +1,14 @@
+import hashlib
+
 from scipy import ndimage as nd
 import numpy as np
-import matplotlib
 from scipy.misc import imresize
-from matplotlib import pylab as plt
 import pandas as pd
 import astropy.wcs
 
+# Parsed WCS objects keyed by a hash of the image header
+_WCS_CACHE = {}
+
 class Aperture(object):
     """
     Class for denfining apertures
@@ -20,14 +23,24 @@ class Aperture(object):
     :type locy: float
 
     :param ap_type: type of aperture used
-    :param type: str eithr `circular` or `region`
+    :param type: str eithr `circular`, `region`, or `optimal`
 
     :param npix: number of pixels used in aperture
     :param type: float
+
+    :param variance: (keyword, required for `optimal` apertures) 
+        variance of each pixel. `im` is then the background-subtracted
+        signal in each pixel
+    :type variance: N x M array
+
+    The aperture outline (`verts`) is only needed when the aperture is
+    written to disk or plotted, so it is computed on first access.
     """
     def __init__(self, *args, **kwargs):
-        self.verts = None
-        self.weights = None
+        self._verts = None
+        self._verts_pix = None
+        self._weights = None
+        self.im_header = None
 
         if len(args)==0:
             return None
@@ -42,18 +55,16 @@ class Aperture(object):
         elif ap_type=='region':
             radius = np.sqrt( npix / np.pi )
             _ap = region_aperture(im, locx, locy, npix)
+        elif ap_type=='optimal':
+            assert kwargs.has_key('variance'), \
+                "optimal apertures require variance keyword"
+            _ap = optimal_aperture(im, kwargs['variance'], locx, locy, npix)
         else:
-            assert False, "ap_type must be circular or aperture"
-
-        verts = _ap.verts
-        verts = pd.DataFrame(verts, columns=['x','y']) 
-        
-        # Convert x, y to sky coordinates
-        wcs = astropy.wcs.find_all_wcs(im_header,keysel=['binary'])[0]
-        verts['ra'], verts['dec'] = wcs.all_pix2world(verts.x,verts.y,0)
+            assert False, "ap_type must be circular, region, or optimal"
 
-        self.verts = verts
-        self.weights = _ap.weights
+        self._verts_pix = _ap._verts_pix
+        self.im_header = im_header
+        self.weights = _ap.compact_weights
         self.npix = npix
         self.ap_type = ap_type
         self.name = "{}-{:.1f}".format(ap_type, npix)
@@ -63,33 +74,292 @@ class Aperture(object):
             self.ap_type, self.npix )
         return outstring
 
+    @property
+    def weights(self):
+        if self._weights is None:
+            return None
+        return self._weights.to_dense()
+
+    @weights.setter
+    def weights(self, weights):
+        if weights is None or isinstance(weights, CompactWeights):
+            self._weights = weights
+        else:
+            self._weights = CompactWeights(weights)
+
+    @property
+    def compact_weights(self):
+        """Weights in their compact (bit-packed or sparse) encoding"""
+        return self._weights
+
+    @property
+    def verts(self):
+        return self.get_verts()
+
+    @verts.setter
+    def verts(self, verts):
+        self._verts = verts
+
+    def get_verts(self):
+        """
+        Return the aperture vertices, computing them on first call
+
+        If the aperture was constructed with an image header, returns
+        a DataFrame with x, y, ra, and dec columns. Otherwise returns
+        an N x 2 array of x, y pixel coordinates.
+        """
+        if self._verts is None:
+            compute_verts([self])
+        return self._verts
+
+    def get_verts_pix(self):
+        """Return N x 2 array of x, y vertices in pixel coordinates"""
+        if self._verts_pix is None:
+            self._verts_pix = mask_to_verts(self.weights)
+        return self._verts_pix
+
     def plot(self):
-        plt.plot(self.verts[:,0],self.verts[:,1],color='LimeGreen')
+        from matplotlib import pylab as plt
+        verts = np.array(self.get_verts())
+        plt.plot(verts[:,0],verts[:,1],color='LimeGreen')
+
+class CompactWeights(object):
+    """
+    Compact encoding of aperture weights
+
+    Most pixels in a stamp are outside the aperture. Apertures with
+    0/1 weights are stored as a bit-packed mask and apertures with
+    fractional weights as (index, weight) pairs for the nonzero pixels.
+
+    :param weights: aperture weights
+    :type weights: N x M array
+    """
+    def __init__(self, weights=None):
+        if weights is None:
+            return None
+
+        weights = np.asarray(weights, dtype=float)
+        self.shape = weights.shape
+        flat = weights.ravel()
+        if np.all((flat==0) | (flat==1)):
+            self.encoding = 'bitpack'
+            self.data = np.packbits(flat.astype(np.uint8))
+        else:
+            self.encoding = 'sparse'
+            index = np.flatnonzero(flat)
+            self.data = np.rec.fromarrays(
+                [index.astype(np.int32), flat[index]], names='index,weight'
+                )
+
+    def __repr__(self):
+        outstring = "<CompactWeights encoding={} shape={}>".format(
+            self.encoding, self.shape)
+        return outstring
+
+    def to_dense(self):
+        """Return weights as N x M array"""
+        npix = int(np.prod(self.shape))
+        if self.encoding=='bitpack':
+            flat = np.unpackbits(self.data)[:npix].astype(float)
+        elif self.encoding=='sparse':
+            flat = np.zeros(npix)
+            flat[self.data['index']] = self.data['weight']
+        else:
+            assert False, "encoding must be bitpack or sparse"
+
+        return flat.reshape(self.shape)
+
+def get_weights_stack(aps):
+    """
+    Stack the weights of many apertures
+
+    :param aps: apertures defined on the same stamp
+    :type aps: list of Aperture objects
+
+    :returns: naper x npix array of weights
+    """
+    return np.array([ap.weights.ravel() for ap in aps])
+
+def header_to_wcs(im_header):
+    """
+    Return the WCS described by the binary table image header
+
+    Parsing the binary table WCS is slow, so WCS objects are cached
+    for each distinct header.
+    """
+    key = hashlib.md5(im_header.tostring()).hexdigest()
+    if key not in _WCS_CACHE:
+        _WCS_CACHE[key] = astropy.wcs.find_all_wcs(
+            im_header, keysel=['binary']
+            )[0]
+    return _WCS_CACHE[key]
+
+def compute_verts(aps):
+    """
+    Compute the vertices of many apertures at once
+
+    Vertices of apertures that share an image header are converted
+    to sky coordinates in a single WCS call. Apertures that already
+    have vertices are skipped.
+
+    :param aps: apertures
+    :type aps: list of Aperture objects
+    """
+    aps = [ap for ap in aps if ap._verts is None]
+
+    # Apertures without a header keep their vertices in pixel coordinates
+    for ap in aps:
+        if ap.im_header is None:
+            ap._verts = ap.get_verts_pix()
+
+    groups = {}
+    for ap in aps:
+        if ap.im_header is not None:
+            groups.setdefault(id(ap.im_header), []).append(ap)
+
+    for group in groups.values():
+        verts_pix = [ap.get_verts_pix() for ap in group]
+        nverts = [len(v) for v in verts_pix]
+        verts = pd.DataFrame(np.vstack(verts_pix), columns=['x','y']) 
+
+        # Convert x, y to sky coordinates
+        wcs = header_to_wcs(group[0].im_header)
+        verts['ra'], verts['dec'] = wcs.all_pix2world(verts.x,verts.y,0)
+
+        split = np.cumsum(nverts)[:-1]
+        for ap, idx in zip(group, np.split(np.arange(len(verts)), split)):
+            ap._verts = verts.iloc[idx].reset_index(drop=True)
 
 def circular_aperture(im, locx, locy, radius):
     verts = _circular_aperture_verts(locx, locy, radius)
     aper = Aperture()
-    aper.verts = verts
+    aper._verts_pix = verts
     aper.weights = verts_to_weights(verts, im.shape, supersamp=10)
     return aper
 
 def region_aperture(im, locx, locy, npix):
+    """
+    Region aperture. Vertices are traced lazily from the weights.
+    """
     order = connected_pixels_order(im, locx, locy)
     weights = ((npix > order) & (order >=0 )).astype(float)
     aper = Aperture()
-    aper.verts = mask_to_verts(weights)
     aper.weights = weights
     return aper
 
-def mask_to_verts(mask,supersamp=10):
-    mask_ss = mask.repeat(supersamp,axis=0).repeat(supersamp,axis=1)
-    x_ss = ( np.arange(mask_ss.shape[1]) + 0.5 ) / supersamp - 0.5
-    y_ss = ( np.arange(mask_ss.shape[0]) + 0.5 ) / supersamp - 0.5
-    x_ss,y_ss = np.meshgrid(x_ss, y_ss)
-    cs = plt.contour(x_ss,y_ss,mask_ss,levels=[0.5],hold=False)
-    verts = cs.allsegs[0][0]
+def optimal_aperture(signal, variance, locx, locy, npix):
+    """
+    S/N-optimal aperture
+
+    Pixels are weighted by signal / variance, which maximizes the S/N
+    of the weighted sum for a star with known profile. Weights are
+    restricted to the npix connected pixels with highest S/N and
+    scaled so the weighted sum of the signal image equals the summed
+    signal in those pixels.
+    """
+    signal = np.where(np.isfinite(signal), signal, 0)
+    signal = np.clip(signal, 0, None)
+    variance = np.where(np.isfinite(variance) & (variance > 0), variance,
+                        np.inf)
+    snr = signal / np.sqrt(variance)
+
+    order = connected_pixels_order(snr, locx, locy)
+    support = ((npix > order) & (order >=0 ))
+    weights = np.where(support, signal / variance, 0)
+    if weights.sum() > 0:
+        weights *= np.sum(signal[support]) / np.sum(weights * signal)
+
+    aper = Aperture()
+    aper.weights = weights
+    return aper
+
+def mask_to_verts(mask):
+    """
+    Trace the outline of a pixel mask along the pixel edges
+
+    Marching squares on the native pixel grid. Every pixel edge that
+    separates a masked pixel from an unmasked one becomes a directed
+    segment (mask on the left), and the segments are chained into
+    closed loops. Corners where the outline continues in a straight
+    line are dropped.
+
+    Parameters
+    ----------
+    mask : 2D array. Pixels > 0 are considered part of the aperture
+
+    Returns
+    -------
+    verts : (N+1) x 2 array of x (column), y (row) vertices of the
+            outline enclosing the largest area. The first vertex is
+            repeated at the end to close the polygon.
+    """
+    mask = np.asarray(mask) > 0
+    if not mask.any():
+        return np.zeros((0,2))
+
+    nrow, ncol = mask.shape
+    pad = np.zeros((nrow + 2, ncol + 2), dtype=bool)
+    pad[1:-1,1:-1] = mask
+    inside = pad[1:-1,1:-1]
+    row, col = np.mgrid[0:nrow,0:ncol]
+
+    # Corner (i, j) is the lower left corner of pixel (row=j, col=i)
+    # and sits at x = i - 0.5, y = j - 0.5. Walk counter-clockwise.
+    edges = []
+    neighbors = [
+        (pad[:-2,1:-1], (0, 0), (1, 0)), # below
+        (pad[1:-1,2:], (1, 0), (1, 1)), # right
+        (pad[2:,1:-1], (1, 1), (0, 1)), # above
+        (pad[1:-1,:-2], (0, 1), (0, 0)), # left
+    ]
+    for neighbor, start, stop in neighbors:
+        b = inside & ~neighbor
+        c, r = col[b], row[b]
+        edges.append(
+            np.vstack([c + start[0], r + start[1], c + stop[0], r + stop[1]]).T
+        )
+
+    edges = np.vstack(edges)
+    nxt = {}
+    for x0, y0, x1, y1 in edges:
+        nxt.setdefault((x0, y0), []).append((x1, y1))
+
+    loops = []
+    while nxt:
+        start = min(nxt.keys())
+        loop = [start]
+        point = start
+        while True:
+            ends = nxt[point]
+            end = ends.pop()
+            if len(ends)==0:
+                nxt.pop(point)
+            if end==start:
+                break
+            loop.append(end)
+            point = end
+
+        loops.append(np.array(loop, dtype=float))
+
+    area = [_polygon_area(loop) for loop in loops]
+    verts = loops[np.argmax(np.abs(area))]
+
+    # Drop vertices that lie on a straight line between neighbors
+    prv = np.roll(verts, 1, axis=0)
+    nxt = np.roll(verts, -1, axis=0)
+    cross = (
+        (verts[:,0] - prv[:,0]) * (nxt[:,1] - verts[:,1]) - 
+        (verts[:,1] - prv[:,1]) * (nxt[:,0] - verts[:,0])
+    )
+    verts = verts[cross!=0]
+    verts = np.vstack([verts, verts[:1]]) - 0.5
     return verts
 
+def _polygon_area(verts):
+    """Signed area of polygon (shoelace formula)"""
+    x, y = verts[:,0], verts[:,1]
+    return 0.5 * np.sum(x * np.roll(y, -1) - np.roll(x, -1) * y)
+
 def verts_to_weights(verts, shape, supersamp=10):
     ss_shape = ( shape[0]*supersamp, shape[1]*supersamp )
     extentx = [-0.5 , shape[1] - 0.5]
@@ -99,8 +369,9 @@ def verts_to_weights(verts, shape, supersamp=10):
     x, y = np.mgrid[ extentx[0] : extentx[1] - 1.0/supersamp : nsampx*1j,
                      extenty[0] : extenty[1] - 1.0/supersamp : nsampy*1j ]
 
+    from matplotlib.path import Path
     points = np.vstack([x.flatten(),y.flatten()]).T
-    path = matplotlib.path.Path(verts)
+    path = Path(verts)
     weights = path.contains_points( points )
     points_in_ap = points[weights]
 
@@ -133,8 +404,7 @@ def connected_pixels_order(im0, locx, locy):
                         [0, 1, 0]])
     weights = weights.astype(float)
     weights /= np.sum(weights)
-    print locx, locy 
-    locr, locc = np.round(locy), np.round(locx)
+    locr, locc = int(np.round(locy)), int(np.round(locx))
 
     # Mask is the aperture mask
     mask = np.zeros(im.shape).astype(float)
@@ -1,35 +1,61 @@
 from argparse import ArgumentParser
 import os
+import sys
+import time
 import sqlite3
+import hashlib
+from multiprocessing import Pool
+from functools import partial
 
 from astropy.io import fits
+from astropy import wcs as astropy_wcs
 import numpy as np
 from numpy import ma
 import h5py
 import pandas as pd
 from matplotlib import mlab
 from matplotlib import pylab as plt
-from scipy import ndimage as nd
 
 import image_transform as imtran
-from io_utils.pixel import get_wcs
+import rolling
 from io_utils import h5plus
 from config import bjd0 
-def channel_transform(fitsfiles, h5file, iref= None):
+def channel_transform(fitsfiles, h5file, iref= None, processes=None, 
+                      centroid_cache='default', centroid_method='moment'):
     """
     Channel Transformation
 
     Take a list of k2 pixel files (must be from the same
     channel). Find the centroids of each image and solve for the
     linear transformation that takes one scene to another
-    """
-    nstars = len(fitsfiles)
 
-    # Pull the first file to get length and data type
-    fitsfile0 = fitsfiles[0]
-    cent0 = fits_to_chip_centroid(fitsfile0)
-    channel = get_channel(fitsfile0)
+    Parameters
+    ----------
+    fitsfiles : list of pixel files
+    h5file : output file
+    iref : index of reference cadence. If None, chosen automatically
+    processes : number of processes used to extract centroids. 
+                Default: all cores
+    centroid_cache : h5 file storing the centroids of every pixel
+                     file, keyed by the checksum of the file. Only
+                     files not in the cache are processed. 'default'
+                     places the cache next to h5file, None disables
+                     the cache.
+    centroid_method : 'moment' or 'gaussian'. See `fits_to_chip_centroid`
+    """
+    if centroid_cache=='default':
+        centroid_cache = None
+        if h5file!=None:
+            centroid_cache = os.path.splitext(h5file)[0] + '_centroids.h5'
+
+    cent = get_chip_centroids(
+        fitsfiles, processes=processes, centroid_cache=centroid_cache,
+        centroid_method=centroid_method
+        )
+    cent0 = cent[0]
+    channel = cent0['channel'][0]
     print "Using channel = %i" % channel
+    assert (cent['channel']==channel).all(), "files from multiple channels"
 
     # Determine the refence frame
     if iref==None:
@@ -48,15 +74,9 @@ def channel_transform(fitsfiles, h5file, iref= None):
     assert np.isnan(cent0['centx'][iref])==False,\
         "Must select a valid reference cadence. No nans"
 
-    cent = np.zeros((nstars,cent0.shape[0]), cent0.dtype)
-    for i,fitsfile in enumerate(fitsfiles):
-        if (i%10)==0:
-            print i
-        cent[i] = fits_to_chip_centroid(fitsfile)
-        channel_i = get_channel(fitsfile)
-        assert channel==channel_i,"%i != %i" % (channel, channel_i)
-
-    trans,pnts = imtran.linear_transform(cent['centx'],cent['centy'],iref)
+    trans,pnts,suffstats = imtran.linear_transform(
+        cent['centx'],cent['centy'],iref,return_suffstats=True
+        )
     trans = pd.DataFrame(trans)
     trans = pd.concat([trans,pd.DataFrame(LE(cent0))[['t','cad']]],axis=1)
     trans = trans.to_records(index=False)
@@ -67,7 +87,18 @@ def channel_transform(fitsfiles, h5file, iref= None):
     if h5file!=None:
         with h5plus.File(h5file) as h5:
             h5['trans'] = trans
-            h5['pnts'] = pnts
+
+            # pnts may grow when stars are added (update_channel_transform)
+            if 'pnts' in h5:
+                del h5['pnts']
+            h5.create_dataset('pnts', data=pnts, maxshape=(None,pnts.shape[1]))
+            h5['suffstats'] = suffstats
+            h5.attrs['iref'] = iref
+            h5.attrs['centroid_method'] = centroid_method
+
+            irep = get_representative_star(pnts['x'], pnts['y'])
+            h5['pnts_rep'] = pnts[irep]
+            h5.attrs['irep'] = irep
             
     trans,pnts = read_channel_transform(h5file)
     plot_trans(trans, pnts)
@@ -76,6 +107,380 @@ def channel_transform(fitsfiles, h5file, iref= None):
     print "saving %s " % figpath
     return cent
 
+def update_channel_transform(fitsfiles, h5file, processes=None,
+                             centroid_cache='default'):
+    """
+    Incremental Channel Transformation
+
+    Add stars to a transformation computed by `channel_transform`.
+    The per-cadence sufficient statistics of the new stars are added
+    to the stored ones, so only cadences where a new star has a valid
+    centroid are refit. Centroids of the new stars are appended to
+    `pnts` in place. Stars already in the transformation are skipped.
+    Unlike `channel_transform`, new stars are not checked for outliers.
+    Centroids use the same method as the stored transformation.
+
+    Parameters
+    ----------
+    fitsfiles : list of pixel files (same channel and campaign)
+    h5file : file written by `channel_transform`
+    processes : number of processes used to extract centroids
+    centroid_cache : see `channel_transform`
+    """
+    if centroid_cache=='default':
+        centroid_cache = os.path.splitext(h5file)[0] + '_centroids.h5'
+
+    with h5py.File(h5file,'r') as h5:
+        assert 'suffstats' in h5, \
+            "%s has no sufficient statistics, rerun channel_transform" % h5file
+        assert h5['pnts'].maxshape[0] is None, "pnts cannot be extended"
+        trans = h5['trans'][:]
+        suffstats = h5['suffstats'][:]
+        iref = h5.attrs['iref']
+        pnts_iref = h5['pnts'][:,iref]
+        pnts_dtype = h5['pnts'].dtype
+        centroid_method = h5.attrs.get('centroid_method', 'moment')
+
+    cent = get_chip_centroids(
+        fitsfiles, processes=processes, centroid_cache=centroid_cache,
+        centroid_method=centroid_method
+        )
+    b = ~np.in1d(cent['starname'][:,0], pnts_iref['starname'])
+    cent = cent[b]
+    print "adding %i stars" % len(cent)
+    if len(cent)==0:
+        return
+
+    assert (cent['channel']==pnts_iref['channel'][0]).all(), \
+        "files from multiple channels"
+    assert (cent['cad'][0]==trans['cad']).all(), "cadences do not match"
+
+    # Add the new stars to the sufficient statistics and refit only
+    # the cadences they touch
+    stats_new = imtran.trans_suffstats(
+        cent['centx'][:,iref], cent['centy'][:,iref], 
+        cent['centx'], cent['centy']
+        )
+    suffstats = imtran.add_suffstats(suffstats, stats_new)
+    icad = np.where(stats_new['n'] > 0)[0]
+    TM,x1o,y1o,x2o,y2o = imtran.fit_6_par_trans_suffstats(suffstats[icad])
+    good = np.isfinite(TM).all(axis=2).all(axis=1)
+    icad = icad[good]
+    TM,x1o,y1o,x2o,y2o = TM[good],x1o[good],y1o[good],x2o[good],y2o[good]
+    print "refitting %i/%i cadences" % (len(icad), len(trans))
+
+    trans['A'][icad] = TM[:,0,0]
+    trans['B'][icad] = TM[:,0,1]
+    trans['C'][icad] = TM[:,1,0]
+    trans['D'][icad] = TM[:,1,1]
+    trans['x1o'][icad] = x1o
+    trans['y1o'][icad] = y1o
+    trans['x2o'][icad] = x2o
+    trans['y2o'][icad] = y2o
+
+    # Points of the new stars. As in linear_transform, cadences
+    # without a valid transformation are left as zeros
+    TM_all = np.array([[trans['A'],trans['B']],[trans['C'],trans['D']]])
+    TM_all = TM_all.transpose(2,0,1)
+    valid = (TM_all!=0).any(axis=2).any(axis=1)
+    x2pr,y2pr = imtran.ref_to_targ_batch(
+        cent['centx'][:,iref], cent['centy'][:,iref], TM_all, 
+        trans['x1o'], trans['y1o'], trans['x2o'], trans['y2o']
+        )
+    pnts_new = np.zeros(cent.shape, dtype=pnts_dtype)
+    for k in cent.dtype.names:
+        pnts_new[k] = cent[k]
+    pnts_new['x'][:,valid] = cent['centx'][:,valid]
+    pnts_new['y'][:,valid] = cent['centy'][:,valid]
+    pnts_new['xpr'][:,valid] = x2pr[:,valid]
+    pnts_new['ypr'][:,valid] = y2pr[:,valid]
+
+    with h5py.File(h5file,'a') as h5:
+        h5['trans'][...] = trans
+        h5['suffstats'][...] = suffstats
+
+        # Transformed points of the existing stars at refit cadences
+        pnts = h5['pnts']
+        if len(icad) > 0:
+            pnts_icad = pnts[:,icad]
+            x2pr,y2pr = imtran.ref_to_targ_batch(
+                pnts_iref['centx'], pnts_iref['centy'], TM, x1o, y1o, x2o, y2o
+                )
+            pnts_icad['x'] = pnts_icad['centx']
+            pnts_icad['y'] = pnts_icad['centy']
+            pnts_icad['xpr'] = x2pr
+            pnts_icad['ypr'] = y2pr
+            pnts[:,icad] = pnts_icad
+
+        nstar = pnts.shape[0]
+        pnts.resize(nstar + len(pnts_new), axis=0)
+        pnts[nstar:] = pnts_new
+
+        # Representative star is either the old one or a new star
+        if 'irep' in h5.attrs:
+            irep = h5.attrs['irep']
+            pnts_cand = np.vstack([pnts[irep][np.newaxis,:], pnts_new])
+            icand = np.hstack([[irep], nstar + np.arange(len(pnts_new))])
+        else:
+            pnts_cand = pnts[:]
+            icand = np.arange(len(pnts_cand))
+
+        i = get_representative_star(pnts_cand['x'], pnts_cand['y'])
+        h5.attrs['irep'] = icand[i]
+        if 'pnts_rep' in h5:
+            del h5['pnts_rep']
+        h5['pnts_rep'] = pnts_cand[i]
+
+def select_channel_stars(dbfile, nstars=50, ngrid=4):
+    """
+    Pick stars used to compute the channel transformations
+
+    Stars are read from the headers database (see
+    `io_utils.scrape_fits_headers`). We want stars spread over the
+    channel so that rotation and scale are well constrained, and
+    small stamps, which are cheap to read and rarely hold saturated
+    stars. Each channel is divided into ngrid x ngrid cells, and
+    stars are taken from the cells in turn, smallest stamps first.
+
+    Parameters
+    ----------
+    dbfile : sqlite3 database of pixel file headers
+    nstars : maximum number of stars per channel
+    ngrid : number of cells along each axis of the channel
+
+    Returns
+    -------
+    stars : DataFrame with fitsfile, channel, and campaign columns
+    """
+    query = """
+    SELECT fitsfile, CHANNEL, CAMPAIGN, TDIM4, REF_ROW, REF_COL
+    FROM headers
+    """
+    con = sqlite3.connect(dbfile)
+    with con:
+        df = pd.read_sql(query, con)
+    con.close()
+
+    df = df.rename(columns={'CHANNEL':'channel','CAMPAIGN':'campaign'})
+    df = df.drop_duplicates(subset=['fitsfile'])
+    df.index = range(len(df))
+
+    # NAXIS1/NAXIS2 describe the binary table, the stamp shape is in
+    # the TDIM keyword of the FLUX column
+    shape = np.array([parse_tdim(tdim) for tdim in df.TDIM4]).reshape(-1,2)
+    nrow, ncol = shape[:,0], shape[:,1]
+    df['npix'] = nrow * ncol
+    row = df.REF_ROW + 0.5 * nrow
+    col = df.REF_COL + 0.5 * ncol
+
+    stars = []
+    for channel, dfch in df.groupby('channel'):
+        # Cell of each star, using the extent of the stars in the channel
+        rowch, colch = row[dfch.index], col[dfch.index]
+        irow = ngrid * (rowch - rowch.min()) / (rowch.max() - rowch.min() + 1)
+        icol = ngrid * (colch - colch.min()) / (colch.max() - colch.min() + 1)
+        dfch = dfch.copy()
+        dfch['cell'] = irow.astype(int) * ngrid + icol.astype(int)
+
+        # Rank of each star within its cell (0 = smallest stamp), so
+        # sorting on rank takes one star from every cell in turn
+        dfch = dfch.sort_values(by=['npix','fitsfile'])
+        dfch['rank'] = dfch.groupby('cell').cumcount()
+        dfch = dfch.sort_values(by=['rank','npix'])
+        stars.append(dfch.iloc[:nstars])
+
+    stars = pd.concat(stars)
+    stars = stars[['fitsfile','channel','campaign']]
+    return stars
+
+def parse_tdim(tdim):
+    """
+    Stamp shape from a TDIM keyword
+
+    TDIM lists the axes fastest varying first, so '(ncol,nrow)'
+    becomes (nrow, ncol).
+    """
+    ncol, nrow = [int(n) for n in tdim.strip().strip('()').split(',')]
+    return nrow, ncol
+
+def campaign_transform(dbfile, pixeldir, outdir, nstars=50, channels=None,
+                       processes=None, centroid_method='moment'):
+    """
+    Channel transformations for every channel of a campaign
+
+    Stars are chosen with `select_channel_stars` and the channels are
+    processed concurrently, one channel per worker. Writes
+    pixeltrans_C<campaign>_ch<channel>.h5 files to outdir and a
+    manifest CSV with the run time and quality of each fit.
+
+    Parameters
+    ----------
+    dbfile : sqlite3 database of pixel file headers
+    pixeldir : directory holding the pixel files
+    outdir : output directory
+    nstars : maximum number of stars per channel
+    channels : [optional] list of channels to process. Default: all
+               channels in the database
+    processes : number of worker processes. Default: all cores
+    centroid_method : see `fits_to_chip_centroid`
+
+    Returns
+    -------
+    manifest : DataFrame with one row per channel
+    """
+    stars = select_channel_stars(dbfile, nstars=nstars)
+    if channels is not None:
+        stars = stars[stars.channel.isin(channels)]
+
+    campaign = stars.campaign.iloc[0]
+    assert (stars.campaign==campaign).all(), "database has many campaigns"
+
+    jobs = []
+    for channel, _stars in stars.groupby('channel'):
+        fitsfiles = [os.path.join(pixeldir, f) for f in _stars.fitsfile]
+        h5file = os.path.join(
+            outdir, "pixeltrans_C%i_ch%02d.h5" % (campaign, channel)
+            )
+        jobs.append((channel, fitsfiles, h5file, centroid_method))
+
+    print "computing transformations for %i channels" % len(jobs)
+    pool = Pool(processes=processes)
+    try:
+        manifest = pool.map(_campaign_transform_channel, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    manifest = pd.DataFrame(manifest)
+    manifest['campaign'] = campaign
+    columns = 'campaign channel nstars ncad nvalid rms time error h5file'
+    manifest = manifest.reindex(columns=columns.split())
+    manifestfn = os.path.join(outdir, "pixeltrans_C%i_manifest.csv" % campaign)
+    manifest.to_csv(manifestfn, index=False)
+    print "saving %s" % manifestfn
+    return manifest
+
+def _campaign_transform_channel(job):
+    """
+    Compute the transformation of one channel
+
+    Runs in a worker of `campaign_transform`. Errors are recorded in
+    the manifest instead of stopping the other channels.
+    """
+    channel, fitsfiles, h5file, centroid_method = job
+    d = dict(channel=channel, h5file=h5file, nstars=len(fitsfiles), error='')
+    start = time.time()
+    try:
+        # Workers of a pool cannot start their own pool
+        channel_transform(
+            fitsfiles, h5file, processes=1, centroid_method=centroid_method
+            )
+        plt.close('all')
+        d = dict(d, **transform_stats(h5file))
+    except:
+        d['error'] = repr(sys.exc_info()[1])
+        print "channel %i failed: %s" % (channel, d['error'])
+
+    d['time'] = time.time() - start
+    return d
+
+def transform_stats(h5file):
+    """
+    Quality of a channel transformation
+
+    Returns
+    -------
+    stats : dictionary with
+            - ncad : number of cadences
+            - nvalid : cadences with a valid transformation
+            - rms : rms distance between the measured and transformed
+              positions of the stars [pixels]
+    """
+    with h5py.File(h5file,'r') as h5:
+        trans = h5['trans'][:]
+        ds = h5['pnts']
+        dx = ds['x'] - ds['xpr']
+        dy = ds['y'] - ds['ypr']
+        valid = (ds['x']!=0) & np.isfinite(dx) & np.isfinite(dy)
+
+    stats = dict(
+        ncad=len(trans), 
+        nvalid=int(((trans['A']!=0) | (trans['D']!=0)).sum()),
+        rms=np.sqrt(np.mean(dx[valid]**2 + dy[valid]**2)),
+        )
+    return stats
+
+def get_chip_centroids(fitsfiles, processes=None, centroid_cache=None,
+                       centroid_method='moment'):
+    """
+    Centroids of many pixel files
+
+    Centroids are extracted in a pool of worker processes. If a
+    cache file is given, previously extracted centroids are looked up
+    by the md5 checksum of the pixel file (and the centroid method),
+    and newly extracted ones are added to the cache.
+
+    Returns
+    -------
+    cent : nstar x ncad record array (see `fits_to_chip_centroid`)
+    """
+    # processes=1 runs serially, e.g. inside a worker of campaign_transform
+    pool = None
+    _map = map
+    if processes!=1:
+        pool = Pool(processes=processes)
+        _map = pool.map
+
+    try:
+        checksums = _map(file_checksum, fitsfiles)
+        if centroid_method!='moment':
+            checksums = [c + '_' + centroid_method for c in checksums]
+
+        centL = dict(zip(checksums, [None] * len(checksums)))
+        if centroid_cache is not None and os.path.exists(centroid_cache):
+            with h5py.File(centroid_cache,'r') as h5:
+                if 'centroids' in h5:
+                    for checksum in checksums:
+                        if checksum in h5['centroids']:
+                            centL[checksum] = h5['centroids'][checksum][:]
+
+        todo = [(f, c) for f, c in zip(fitsfiles, checksums) if centL[c] is None]
+        print "{} files in centroid cache, {} to process".format(
+            len(fitsfiles) - len(todo), len(todo))
+        new = _map(
+            partial(fits_to_chip_centroid, method=centroid_method),
+            [f for f, c in todo]
+            )
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    for (fitsfile, checksum), r in zip(todo, new):
+        centL[checksum] = r
+
+    if centroid_cache is not None and len(todo) > 0:
+        with h5plus.File(centroid_cache) as h5:
+            group = h5.require_group('centroids')
+            for fitsfile, checksum in todo:
+                if checksum not in group:
+                    group[checksum] = centL[checksum]
+                    group[checksum].attrs['fitsfile'] = fitsfile
+
+    cent0 = centL[checksums[0]]
+    cent = np.zeros((len(fitsfiles),cent0.shape[0]), cent0.dtype)
+    for i, checksum in enumerate(checksums):
+        cent[i] = centL[checksum]
+    return cent
+
+def file_checksum(fn, blocksize=2**20):
+    """Return md5 checksum of file contents"""
+    md5 = hashlib.md5()
+    with open(fn,'rb') as f:
+        for block in iter(lambda : f.read(blocksize), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
 def centroid(flux):
     """
     Centroid
@@ -103,13 +508,74 @@ def centroid(flux):
     centcol = np.sum( (fluxcol*icol), axis=1) / np.sum(fluxcol,axis=1)
     return centcol,centrow
 
-def fits_to_chip_centroid(fitsfile):
+def gaussian_centroid(flux):
+    """
+    Centroid from a Gaussian fit
+
+    Fits ln(flux) = a + b*x + c*y + d*x**2 + e*y**2, the log of an
+    axis-aligned 2D Gaussian, which is linear in the parameters. The
+    least squares problem is weighted by flux**2 to undo the
+    amplification of noise in faint pixels by the log. The 5x5 normal
+    equations of all frames are built and solved at once. Frames where
+    the fit fails (too few pixels, not a peak, or a center outside of
+    the image) fall back to the first moment from `centroid`.
+
+    Parameters
+    ----------
+    flux : flux cube (already should be masked and background subtracted)
+
+    Returns
+    -------
+    centcol : Centroid of along column axis. 0 corresponds to origin
+    centrow : Centroid of along row axis. 0 corresponds to origin
+    """
+    nframe,nrow,ncol = flux.shape
+    irow,icol = np.mgrid[:nrow,:ncol]
+    irow = irow.flatten() - 0.5 * (nrow - 1)
+    icol = icol.flatten() - 0.5 * (ncol - 1)
+    A = np.vstack([np.ones(nrow*ncol), icol, irow, icol**2, irow**2]).T
+
+    flux = flux.reshape(nframe,-1)
+    with np.errstate(invalid='ignore'):
+        use = np.isfinite(flux) & (flux > 0)
+    w = np.where(use, flux, 0)**2
+    lnflux = np.log(np.where(use, flux, 1))
+
+    # Normal equations, nframe x 5 x 5 and nframe x 5
+    AtWA = np.einsum('fp,pi,pj->fij', w, A, A)
+    AtWb = np.einsum('fp,pi,fp->fi', w, A, lnflux)
+
+    good = use.sum(axis=1) >= 5
+    good[good] = np.abs(np.linalg.det(AtWA[good])) > 0
+    p = np.zeros((nframe,5))
+    p[good] = np.linalg.solve(AtWA[good], AtWb[good][:,:,np.newaxis])[:,:,0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        centcol = -0.5 * p[:,1] / p[:,3] + 0.5 * (ncol - 1)
+        centrow = -0.5 * p[:,2] / p[:,4] + 0.5 * (nrow - 1)
+
+    with np.errstate(invalid='ignore'):
+        good = good & (p[:,3] < 0) & (p[:,4] < 0)
+        good = good & (centcol > 0) & (centcol < ncol - 1)
+        good = good & (centrow > 0) & (centrow < nrow - 1)
+    if not good.all():
+        flux = flux.reshape(nframe,nrow,ncol)
+        centcol0,centrow0 = centroid(flux[~good])
+        centcol[~good] = centcol0
+        centrow[~good] = centrow0
+
+    return centcol,centrow
+
+def fits_to_chip_centroid(fitsfile, method='moment'):
     """
     Grab centroids from fits file
 
     Parameters
     ----------
     fitsfile : path to pixel file
+    method : 'moment' uses the flux-weighted first moment (`centroid`).
+             'gaussian' fits a Gaussian (`gaussian_centroid`). Unlike
+             the moment, the fit is not pulled toward the center of
+             the box by errors in the background
 
     Returns
     -------
@@ -118,6 +584,7 @@ def fits_to_chip_centroid(fitsfile):
     """
     apsize = 7
 
+    # Open the file once. WCS and channel come from the same handle
     hdu0,hdu1,hdu2 = fits.open(fitsfile)
     cube = hdu1.data
     flux = cube['FLUX']
@@ -127,7 +594,7 @@ def fits_to_chip_centroid(fitsfile):
     nframe,nrow,ncol = flux.shape
 
     # Define rectangular aperture
-    wcs = get_wcs(fitsfile)
+    wcs = astropy_wcs.WCS(header=hdu2.header,key=' ')
     ra,dec = hdu0.header['RA_OBJ'],hdu0.header['DEC_OBJ']
     try:
         x,y = wcs.wcs_world2pix(ra,dec,0)
@@ -166,7 +633,15 @@ def fits_to_chip_centroid(fitsfile):
     fsap = np.sum(fsap.reshape(fsap.shape[0],-1),axis=1)
 
     # Compute centroids
-    centx,centy = centroid(flux * mask)
+    if method=='moment':
+        centx,centy = centroid(flux * mask)
+    elif method=='gaussian':
+        box = (slice(None), slice(max(y0,0),y1+1), slice(max(x0,0),x1+1))
+        centx,centy = gaussian_centroid(flux[box])
+        centx += max(x0,0)
+        centy += max(y0,0)
+    else:
+        assert False, "method must be moment or gaussian"
 
     # table column physical WCS ax 1 ref value       
     # hdu1.header['1CRV4P'] corresponds to column of flux[:,0,0]
@@ -180,6 +655,7 @@ def fits_to_chip_centroid(fitsfile):
         )
 
     r = mlab.rec_append_fields(r,'starname',hdu0.header['KEPLERID'])
+    r = mlab.rec_append_fields(r,'channel',hdu0.header['CHANNEL'])
     return r
 
 def get_channel(fitsfile):
@@ -209,9 +685,10 @@ def get_thrustermask(dtheta):
     sigfiltwid = 100 # Filter width to establish local scatter in dtheta
     thresh = 10 # Threshold to call something a thruster fire (units of sigma)
 
-    medtheta = nd.median_filter(dtheta,medfiltwid)
-    diffdtheta = np.abs(dtheta - medtheta)
-    sigma = nd.median_filter(diffdtheta,sigfiltwid) * 1.5
+    diffdtheta, sigma = rolling.rolling_mad(
+        dtheta, sigfiltwid, medsize=medfiltwid
+        )
+    sigma = sigma * 1.5
     thrustermask = np.array(diffdtheta > thresh*sigma)
     idx = np.where(thrustermask)[0]
     mask_after = idx + 1 # mask cadence after
@@ -244,7 +721,7 @@ def get_thrustermask_pos(trans):
     ypr = np.array(trans.ypr)
     dpix = np.sqrt((xpr[1:] - xpr[:-1])**2 + (ypr[1:] - ypr[:-1])**2)
     dpix = np.hstack([[0],dpix])
-    dpixfilt = dpix - nd.median_filter(dpix,medfiltwid)
+    dpixfilt = dpix - rolling.rolling_median(dpix,medfiltwid)
     thrustermask = dpixfilt > np.percentile(dpixfilt,thruster_quantile)
     return thrustermask
 
@@ -292,20 +769,56 @@ def LE(arr):
     arrL = np.rec.fromarrays(arrL,names=names)
     return arrL
 
+def get_representative_star(x, y):
+    """
+    Index of the star used for the x-y position of the channel
+
+    Hack: the star whose median position is nearest pixel (500,500)
+    """
+    sqdist = (
+        (np.median(x,axis=1) - 500)**2 +
+        (np.median(y,axis=1) - 500)**2 
+        )
+    return np.argmin(sqdist)
+
+# Transformations already read by this process, keyed by path and
+# modification time
+_TRANS_CACHE = {}
+
 def read_channel_transform(h5file):
+    """
+    Read transformation computed with `channel_transform`
+
+    The result is cached, so that repeated calls (e.g. once per
+    aperture) only read the file once. The cache is invalidated when
+    the file is modified.
+
+    Returns
+    -------
+    trans : DataFrame with the transformation and derived quantities
+    pnts : DataFrame with xpr, ypr of the representative star
+    """
+    key = (os.path.abspath(h5file), os.path.getmtime(h5file))
+    if key not in _TRANS_CACHE:
+        _TRANS_CACHE[key] = _read_channel_transform(h5file)
+    
+    trans, pnts = _TRANS_CACHE[key]
+    return trans.copy(), pnts.copy()
+
+def _read_channel_transform(h5file):
     with h5py.File(h5file,'r') as h5:
         trans = h5['trans'][:] 
-        pnts = h5['pnts'][:]
+        if 'pnts_rep' in h5:
+            pnts500 = h5['pnts_rep'][:]
+        else:
+            # Older files. Only read the fields needed to pick the star
+            ds = h5['pnts']
+            irep = get_representative_star(ds['x'], ds['y'])
+            pnts500 = ds[irep]
 
     trans = LE(trans)
-    pnts = LE(pnts)
-    # Hack select a representative star to use for x-y position 
-    sqdist = (
-        (np.median(pnts['x'],axis=1) - 500)**2 +
-        (np.median(pnts['y'],axis=1) - 500)**2 
-        )
-    pnts500 = pnts[np.argmin(sqdist)]
-    pnts = pd.DataFrame(pnts[0]['cad'.split()])
+    pnts500 = LE(pnts500)
+    pnts = pd.DataFrame(pnts500['cad'.split()])
     pnts['xpr'] = pnts500['xpr']
     pnts['ypr'] = pnts500['ypr']
 
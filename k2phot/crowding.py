@@ -0,0 +1,70 @@
+"""
+Crowding and contamination of apertures
+
+Neighboring catalog stars are rendered into the stamp and the flux
+each trial aperture collects from the target and from its neighbors
+is computed for all apertures at once.
+"""
+import numpy as np
+import pandas as pd
+
+import synthetic
+
+# Width of the Gaussian PSF used when no PRF is given [pixels]. The
+# K2 PSF has a FWHM of about 2 pixels (6 arcsec), i.e. sigma of about
+# 1 pixel once pointing jitter is included. Narrower PSFs put too
+# little of each neighbor's flux in the aperture and underestimate
+# contamination.
+psf_sigma = 1.0
+
+def contamination(stars, epic, shape, weights, sigma=psf_sigma, prf=None):
+    """
+    Contamination of apertures by neighboring stars
+
+    Parameters
+    ----------
+    stars : DataFrame of catalog stars with pix0 (column), pix1
+            (row), and kepmag columns, indexed by epic. Output of
+            `io_utils.pixel.get_stars_pix`
+    epic : id of the target star
+    shape : (nrow, ncol) of the stamp
+    weights : naper x npix stack of aperture weights (see
+              `apertures.get_weights_stack`)
+    sigma : width of the Gaussian PSF [pixels]
+    prf : [optional] pixel-integrated PRF stamps (output of
+          `synthetic.prf_stamps`). If given, stars are rendered with
+          the Kepler PRF instead of a Gaussian
+
+    Returns
+    -------
+    crowd : DataFrame with one row per aperture and the columns
+            - ftarget : flux from the target in the aperture
+            - fcontam : flux from neighbors in the aperture
+            - contam : fcontam / (ftarget + fcontam)
+            - dilution : (ftarget + fcontam) / ftarget. Transit
+              depths in the aperture are shallower by this factor
+            - frac_target : fraction of the target flux captured
+    """
+    weights = np.asarray(weights).reshape(len(weights),-1)
+    flux = np.array(synthetic.kepmag_to_flux(stars.kepmag))
+    x = np.array(stars.pix0)
+    y = np.array(stars.pix1)
+
+    istarget = np.array(stars.index==epic)
+    assert istarget.sum()==1, "target {} not in stars".format(epic)
+
+    def render(b):
+        if prf is not None:
+            return synthetic.render_prf(shape, x[b], y[b], flux[b], prf)
+        return synthetic.render_stars(shape, x[b], y[b], flux[b], sigma=sigma)
+
+    target = render(istarget).ravel()
+    others = render(~istarget).ravel()
+
+    crowd = pd.DataFrame(dict(
+        ftarget=np.dot(weights, target), fcontam=np.dot(weights, others)
+        ))
+    crowd['contam'] = crowd.fcontam / (crowd.ftarget + crowd.fcontam)
+    crowd['dilution'] = (crowd.ftarget + crowd.fcontam) / crowd.ftarget
+    crowd['frac_target'] = crowd.ftarget / flux[istarget].sum()
+    return crowd
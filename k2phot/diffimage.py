@@ -0,0 +1,139 @@
+"""
+Difference imaging
+
+The roll of the spacecraft moves the scene across the stamp, which
+changes the flux falling in a fixed aperture. Here we build a
+reference frame from the median of the registered stack and shift it
+to the position of the scene at every cadence using the channel
+transformation. Subtracting the shifted reference leaves residual
+images that are free of the motion. Photometry of the residuals plus
+the (constant) photometry of the reference gives a light curve without
+motion-induced losses, which helps for crowded stars.
+
+Shifts are applied with FFTs to blocks of frames, so the complex
+padded arrays never span the whole cube. `ImageStack` keeps only the
+reference frame and the motion, and computes the difference images a
+block at a time when photometry is requested (see
+`imagestack.diffimage_block`).
+"""
+import numpy as np
+import pandas as pd
+
+# Pixels added on each side of the stamp before shifting with FFTs,
+# so that flux wrapping around the edges is not added to the stamp
+npad = 4
+
+def get_stamp_motion(trans, cad, col, row):
+    """
+    Per-cadence motion of the stamp
+
+    Evaluates the affine transformation of every cadence at the
+    center of the stamp.
+
+    Parameters
+    ----------
+    trans : DataFrame returned by `read_channel_transform`
+    cad : cadence numbers of the image stack
+    col, row : chip coordinates of the stamp center (same convention
+               as the centroids in `fits_to_chip_centroid`)
+
+    Returns
+    -------
+    dx : displacement along x (column) axis relative to the median
+         position [pixels]. Cadences without a valid transformation
+         are not shifted
+    dy : same along y (row) axis
+    """
+    trans = pd.DataFrame(trans).drop_duplicates(subset=['cad'])
+    trans = trans.set_index('cad').reindex(np.asarray(cad))
+    valid = (trans['A']!=0) | (trans['D']!=0)
+    dx1 = col - trans['x1o']
+    dy1 = row - trans['y1o']
+    pos = pd.DataFrame(dict(
+        x=trans['A'] * dx1 + trans['B'] * dy1 + trans['x2o'],
+        y=trans['C'] * dx1 + trans['D'] * dy1 + trans['y2o'],
+        ))
+    pos[~valid] = np.nan
+    pos = pos - pos.median()
+    pos = pos.fillna(0)
+    dx = np.array(pos['x'])
+    dy = np.array(pos['y'])
+    return dx, dy
+
+def fft_shift(cube, dx, dy):
+    """
+    Shift every frame of a cube by a subpixel amount
+
+    Parameters
+    ----------
+    cube : nframe x nrow x ncol array, or a single nrow x ncol frame
+           that is shifted by every (dx, dy) pair
+    dx : length nframe array. Shift along x (column) axis [pixels]
+    dy : length nframe array. Shift along y (row) axis [pixels]
+
+    Returns
+    -------
+    shifted : nframe x nrow x ncol array. shifted[i](x, y) =
+              cube[i](x - dx[i], y - dy[i])
+    """
+    cube = np.asarray(cube, dtype=float)
+    dx = np.asarray(dx, dtype=float)
+    dy = np.asarray(dy, dtype=float)
+    nrow, ncol = cube.shape[-2:]
+    pad = [(0,0)] * (cube.ndim - 2) + [(npad,npad), (npad,npad)]
+    cube = np.pad(cube, pad, mode='edge')
+
+    ky = np.fft.fftfreq(nrow + 2*npad)[np.newaxis,:,np.newaxis]
+    kx = np.fft.fftfreq(ncol + 2*npad)[np.newaxis,np.newaxis,:]
+    ramp = np.exp(
+        -2j * np.pi * (kx * dx[:,np.newaxis,np.newaxis] +
+                       ky * dy[:,np.newaxis,np.newaxis])
+        )
+    shifted = np.fft.ifft2(np.fft.fft2(cube) * ramp).real
+    shifted = shifted[:,npad:npad+nrow,npad:npad+ncol]
+    return shifted
+
+def reference_frame(flux, dx, dy, block=256):
+    """
+    Reference frame
+
+    Median of the stack after every cadence is shifted back to the
+    median position.
+
+    Parameters
+    ----------
+    flux : nframe x nrow x ncol array. Missing pixels are nan
+    dx, dy : output of `get_stamp_motion`
+    block : number of frames shifted at once
+
+    Returns
+    -------
+    ref : nrow x ncol array
+    """
+    # FFTs cannot handle missing pixels. Fill them with the median
+    # frame, which is close to the right value
+    medframe = np.nanmedian(flux, axis=0)
+    medframe[~np.isfinite(medframe)] = 0
+
+    registered = np.empty(flux.shape)
+    for i in range(0, len(flux), block):
+        frames = slice(i, i + block)
+        filled = np.where(
+            np.isfinite(flux[frames]), flux[frames], medframe[np.newaxis]
+            )
+        registered[frames] = fft_shift(filled, -dx[frames], -dy[frames])
+
+    registered[~np.isfinite(flux)] = np.nan
+    ref = np.nanmedian(registered, axis=0)
+    ref[~np.isfinite(ref)] = 0
+    return ref
+
+def difference_images(flux, ref, dx, dy):
+    """
+    Subtract the shifted reference from every cadence
+
+    Returns
+    -------
+    resid : nframe x nrow x ncol array of residual images
+    """
+    return flux - fft_shift(ref, dx, dy)
@@ -0,0 +1,604 @@
+"""
+Gaussian process solvers for detrending against time and roll
+
+The GP in `pixdecor.detrend_t_roll_2D` has a squared exponential
+kernel in (t, roll)
+
+    k(x1, x2) = sigma**2 exp(-0.5 (dt**2 / length_t**2 +
+                                   droll**2 / length_roll**2))
+
+plus white noise sigma_n. Solving it exactly costs O(n**3). The
+solvers here share one interface (`compute` then `predict`) so the
+detrending can trade accuracy for speed:
+
+- dense : exact solution with george's basic solver
+- hodlr : george's hierarchical off-diagonal low-rank solver
+- fitc, vfe : sparse approximations built on inducing points that
+  tile the (t, roll) plane (Snelson & Ghahramani 2006; Titsias
+  2009). Cost is O(n m**2) for m inducing points.
+
+Prediction returns the mean, and optionally the diagonal of the
+predictive covariance, without forming the full ncad x ncad matrix.
+`get_cached_solver` keeps the last factorized solver around, with
+the cross-covariances between the training points and the points it
+predicts at, so detrending many apertures of the same star (same
+hyperparameters, same training cadences) costs one factorization and
+then only solves and matrix-vector products.
+`predict` also accepts a matrix with one light curve per column, so
+many apertures are detrended with a single matrix-matrix solve.
+
+`optimize_hyperparameters` fits the hyperparameters by maximizing the
+log marginal likelihood on a subsample of the cadences.
+"""
+import time
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import pandas as pd
+from scipy import linalg
+from scipy.optimize import minimize
+import george
+
+def kernel_t_roll(X1, X2, sigma, length_t, length_roll):
+    """
+    Squared exponential covariance between two sets of points
+
+    Parameters
+    ----------
+    X1 : n1 x 2 array of (t, roll)
+    X2 : n2 x 2 array of (t, roll)
+
+    Returns
+    -------
+    K : n1 x n2 covariance matrix
+    """
+    X1 = np.asarray(X1, dtype=float) / [length_t, length_roll]
+    X2 = np.asarray(X2, dtype=float) / [length_t, length_roll]
+    r2 = (
+        np.sum(X1**2, axis=1)[:,np.newaxis] +
+        np.sum(X2**2, axis=1)[np.newaxis,:] -
+        2 * np.dot(X1, X2.T)
+        )
+    r2 = np.maximum(r2, 0)
+    return sigma**2 * np.exp(-0.5 * r2)
+
+class Solver(object):
+    """
+    Common prediction code of the GP solvers
+
+    Subclasses implement `compute`, `downdate` (remove training
+    points), `_alpha` (weights of the training points), `cross_cov`,
+    and `_reduction` (used for the variance).
+
+    Prediction only returns the mean unless the variance is asked
+    for, and then only its diagonal. The full ncad x ncad predictive
+    covariance is never formed. Unless the solver keeps its
+    cross-covariances (`keep_cross_cov`, set by `get_cached_solver`),
+    they are computed `block_size` rows at a time, so memory does not
+    grow as ncad**2.
+    """
+    block_size = 1024
+    keep_cross_cov = False
+
+    def _get_cross_cov(self, X):
+        """Cross-covariance, cached if keep_cross_cov is set"""
+        X = np.ascontiguousarray(X, dtype=float)
+        if not self.keep_cross_cov:
+            return self.cross_cov(X)
+
+        key = X.tostring()
+        if not self.Kxs.has_key(key):
+            self.Kxs[key] = self.cross_cov(X)
+        return self.Kxs[key]
+
+    def predict(self, y, X, return_var=False):
+        """
+        Predictive mean (and variance) at points X
+
+        Parameters
+        ----------
+        y : training data. Either a length n array or an n x k matrix
+            of k light curves, which are solved for at once
+        X : m x 2 array of (t, roll) to predict at
+        return_var : if True, also return the predictive variance at X
+                     (the diagonal of the predictive covariance)
+
+        Returns
+        -------
+        mu : length m array (or m x k matrix)
+        var : length m array, if return_var is True
+        """
+        alpha = self._alpha(y)
+        X = np.asarray(X, dtype=float)
+        if self.keep_cross_cov:
+            blocks = [slice(0, len(X))]
+        else:
+            blocks = [
+                slice(i, i + self.block_size) 
+                for i in range(0, len(X), self.block_size)
+                ]
+
+        mu = []
+        var = []
+        for block in blocks:
+            Kxs = self._get_cross_cov(X[block])
+            mu.append(np.dot(Kxs, alpha))
+            if return_var:
+                var.append(self.sigma**2 - self._reduction(Kxs))
+
+        mu = np.concatenate(mu)
+        if return_var:
+            var = np.maximum(np.concatenate(var), 0)
+            return mu, var
+
+        return mu
+
+class GeorgeSolver(Solver):
+    """
+    Exact GP using george
+
+    :param solver: george solver class (george.BasicSolver or
+        george.HODLRSolver)
+
+    Extra keyword arguments are passed to the george solver.
+
+    The kernel is normalized to unit amplitude and the data are scaled
+    by 1/sigma. This leaves the predictive mean unchanged, but the
+    HODLR factorization loses a lot of precision when the entries of
+    the matrix are small (sigma ~ 1e-3 for relative flux).
+    """
+    def __init__(self, sigma, length_t, length_roll,
+                 solver=george.BasicSolver, **kwargs):
+        self.sigma = sigma
+        self.length_t = length_t
+        self.length_roll = length_roll
+        kernel = george.kernels.ExpSquaredKernel(
+            [length_t**2,length_roll**2],ndim=2
+            )
+        self.gp = george.GP(kernel, solver=solver, **kwargs)
+
+    # Refactorize instead of downdating once more than this fraction
+    # of the factorized points has been removed
+    downdate_max_frac = 0.1
+
+    def compute(self, X, sigma_n):
+        """
+        Factorize the covariance matrix of the training points
+
+        Light curves are already ordered in time, which keeps nearby
+        points in the same blocks of the HODLR matrix, so we skip
+        george's kd-tree sort.
+        """
+        self.X0 = np.array(X, dtype=float)
+        self.sigma_n = sigma_n
+        self._factor(np.arange(len(self.X0)))
+
+    def _factor(self, ikeep):
+        """Factorize the covariance of training points X0[ikeep]"""
+        self.ikeep = ikeep
+        self.X = self.X0[ikeep]
+        self.gp.compute(self.X, self.sigma_n / self.sigma, sort=False)
+        self.Kxs = {}
+        self.iremove = np.zeros(0, dtype=int) # removed rows of self.X
+        self.Z = np.zeros((len(ikeep), 0)) # columns of K^-1 of those rows
+
+    def downdate(self, mask):
+        """
+        Remove training points without refactorizing
+
+        Uses the block inverse identity: with the removed points S and
+        the kept points R, (K_RR)^-1 y_R = u_R - Z_RS (Z_SS)^-1 u_S,
+        where u = K^-1 y (y_S = 0) and Z = K^-1[:,S]. Removing k points
+        costs k solves with the existing factor instead of a new
+        factorization.
+
+        Parameters
+        ----------
+        mask : boolean array over the points passed to `compute`. True
+               points are removed. Points removed earlier stay removed
+        """
+        mask = np.array(mask, dtype=bool)
+        mask[self.ikeep[self.iremove]] = True # removed earlier
+        iremove = np.where(mask[self.ikeep])[0]
+        inew = np.setdiff1d(iremove, self.iremove)
+        if len(inew)==0:
+            return
+
+        if len(iremove) > self.downdate_max_frac * len(self.ikeep):
+            self._factor(self.ikeep[~mask[self.ikeep]])
+            return
+
+        E = np.zeros((len(self.ikeep), len(inew)))
+        E[inew, np.arange(len(inew))] = 1
+        Znew = self.gp.solver.apply_inverse(E, in_place=True)
+        self.Z = np.hstack([self.Z, Znew.reshape(len(self.ikeep),-1)])
+        self.iremove = np.append(self.iremove, inew)
+
+    def _apply_inverse(self, b):
+        """
+        K^-1 b for the unit amplitude covariance of the kept points
+
+        b has one row per factorized point. Rows of removed points are
+        ignored and zero in the output.
+        """
+        b = np.array(b, dtype=float, order='C')
+        b[self.iremove] = 0
+        u = self.gp.solver.apply_inverse(b, in_place=True)
+        if len(self.iremove) > 0:
+            u_S = u[self.iremove]
+            u = u - np.dot(self.Z, np.linalg.solve(self.Z[self.iremove], u_S))
+        return u
+
+    def cross_cov(self, X):
+        """Covariance between X and the training points"""
+        return kernel_t_roll(
+            X, self.X, self.sigma, self.length_t, self.length_roll
+            )
+
+    def _alpha(self, y):
+        """K^-1 y, with K the covariance of the training points"""
+        y = np.asarray(y, dtype=float)[self.ikeep]
+        return self._apply_inverse(y / self.sigma) / self.sigma
+
+    def _reduction(self, Kxs):
+        """diag(Kxs K^-1 Kxs^T)"""
+        KinvKxsT = self._apply_inverse(Kxs.T / self.sigma)
+        return np.sum(Kxs * KinvKxsT.T, axis=1) / self.sigma
+
+class InducingSolver(Solver):
+    """
+    Sparse GP on inducing points
+
+    Inducing points are the mean position of the training points in
+    each occupied cell of a grid on (t, roll). Cells are `spacing`
+    length scales wide, so the number of inducing points grows with
+    the extent of the light curve in units of the length scales, not
+    with the number of cadences.
+
+    :param method: 'fitc' (fully independent training conditional) or
+        'vfe' (variational free energy). FITC corrects the diagonal of
+        the approximate covariance; VFE keeps the exact noise term.
+    :type method: str
+
+    :param spacing: size of grid cells [length scales]
+    :type spacing: float
+    """
+    def __init__(self, sigma, length_t, length_roll, method='fitc',
+                 spacing=0.5):
+        assert ['fitc','vfe'].count(method)==1, "method must be fitc or vfe"
+        self.sigma = sigma
+        self.length_t = length_t
+        self.length_roll = length_roll
+        self.method = method
+        self.spacing = spacing
+
+    def kernel(self, X1, X2):
+        return kernel_t_roll(
+            X1, X2, self.sigma, self.length_t, self.length_roll
+            )
+
+    def get_inducing_points(self, X):
+        """Mean position of the points in every occupied cell"""
+        cell = np.floor(
+            X / (self.spacing * np.array([self.length_t, self.length_roll]))
+            )
+        df = pd.DataFrame(X, columns=['t','roll'])
+        df['it'] = cell[:,0]
+        df['iroll'] = cell[:,1]
+        Z = df.groupby(['it','iroll'])[['t','roll']].mean()
+        return np.array(Z)
+
+    def compute(self, X, sigma_n):
+        """
+        Factorize the approximate covariance matrix
+
+        With Kmm = L L^T and V = L^-1 Kmn, the approximate covariance
+        is V^T V + Lambda. We factor A = I + V Lambda^-1 V^T = La La^T
+        (m x m) instead of the n x n covariance.
+        """
+        X = np.asarray(X, dtype=float)
+        self.Z = self.get_inducing_points(X)
+        m = len(self.Z)
+
+        Kmm = self.kernel(self.Z, self.Z)
+        Kmm[np.diag_indices(m)] += 1e-6 * self.sigma**2 # jitter
+        self.L = linalg.cholesky(Kmm, lower=True)
+        self.V = linalg.solve_triangular(self.L, self.kernel(self.Z, X), lower=True)
+
+        self.Lambda = np.zeros(len(X)) + sigma_n**2
+        if self.method=='fitc':
+            self.Lambda += self.sigma**2 - np.sum(self.V**2, axis=0)
+
+        self._factor_A()
+        self.Kxs = {}
+
+    def _factor_A(self):
+        """Cholesky factor of A = I + V Lambda^-1 V^T"""
+        m = len(self.Z)
+        A = np.eye(m) + np.dot(self.V / self.Lambda, self.V.T)
+        self.La = linalg.cholesky(A, lower=True)
+
+    def downdate(self, mask):
+        """
+        Remove training points
+
+        Removed points get infinite noise, so they drop out of A. Only
+        the m x m matrix A is refactorized; the inducing points stay
+        the same.
+
+        Parameters
+        ----------
+        mask : boolean array over the points passed to `compute`. True
+               points are removed
+        """
+        mask = np.asarray(mask, dtype=bool)
+        if np.all(np.isinf(self.Lambda[mask])):
+            return
+
+        self.Lambda[mask] = np.inf
+        self._factor_A()
+
+    def cross_cov(self, X):
+        """Covariance between X and the inducing points"""
+        return self.kernel(X, self.Z)
+
+    def _alpha(self, y):
+        """
+        Weights of the inducing points, mu = K*m alpha
+
+        alpha = L^-T A^-1 V Lambda^-1 y
+        """
+        y = np.array(y, dtype=float)
+        y[np.isinf(self.Lambda)] = 0 # removed points
+        Lambda = self.Lambda.reshape((-1,) + (1,) * (y.ndim - 1))
+        b = np.dot(self.V, y / Lambda)
+        alpha = linalg.cho_solve((self.La, True), b)
+        alpha = linalg.solve_triangular(self.L, alpha, lower=True, trans='T')
+        return alpha
+
+    def _reduction(self, Kxs):
+        """
+        Reduction of the prior variance, |W|**2 - |La^-1 W|**2 with
+        W = L^-1 Km*
+        """
+        W = linalg.solve_triangular(self.L, Kxs.T, lower=True)
+        WA = linalg.solve_triangular(self.La, W, lower=True)
+        return np.sum(W**2, axis=0) - np.sum(WA**2, axis=0)
+
+def get_solver(solver, sigma, length_t, length_roll, **kwargs):
+    """
+    GP solver by name
+
+    Parameters
+    ----------
+    solver : 'dense', 'hodlr', 'fitc', or 'vfe'
+    sigma, length_t, length_roll : hyperparameters of the kernel
+    kwargs : passed to the solver class
+    """
+    if solver=='dense':
+        return GeorgeSolver(sigma, length_t, length_roll, **kwargs)
+    elif solver=='hodlr':
+        return GeorgeSolver(
+            sigma, length_t, length_roll, solver=george.HODLRSolver, **kwargs
+            )
+    elif solver=='fitc' or solver=='vfe':
+        return InducingSolver(
+            sigma, length_t, length_roll, method=solver, **kwargs
+            )
+    else:
+        assert False, "solver must be dense, hodlr, fitc, or vfe"
+
+# Last factorized solver of each thread, see get_cached_solver
+_SOLVER_CACHE = threading.local()
+
+def get_cached_solver(solver, sigma, length_t, length_roll, sigma_n, X):
+    """
+    Factorized GP solver, reused between calls
+
+    The solver is keyed by the hyperparameters and the training
+    points, i.e. the (t, roll) of the cadences that are not masked. If
+    they match the previous call, the factorization and the
+    cross-covariances computed so far are reused. Only one solver is
+    kept per thread since the matrices are large (ncad x ncad for
+    dense solvers). Threads do not share solvers, so segments
+    detrended concurrently (`pixdecor.detrend_t_roll_2D_segments`)
+    neither evict each other's solver nor race on the cache.
+
+    Parameters
+    ----------
+    solver : name of the solver (see `get_solver`)
+    sigma, length_t, length_roll, sigma_n : hyperparameters
+    X : n x 2 array of (t, roll) of training points
+
+    Returns
+    -------
+    gp : solver on which `compute` has been called
+    """
+    X = np.ascontiguousarray(X, dtype=float)
+    key = (
+        solver, sigma, length_t, length_roll, sigma_n,
+        hashlib.sha1(X.tostring()).hexdigest()
+        )
+    if not hasattr(_SOLVER_CACHE, 'solvers'):
+        _SOLVER_CACHE.solvers = {}
+
+    gp = _SOLVER_CACHE.solvers.get(key)
+    if gp is not None:
+        return gp
+
+    gp = get_solver(solver, sigma, length_t, length_roll)
+    gp.keep_cross_cov = True
+    gp.compute(X, sigma_n)
+    _SOLVER_CACHE.solvers = {key: gp}
+    return gp
+
+def compare_solvers(lc, sigma, length_t, length_roll, sigma_n,
+                    solvers=['dense','hodlr','fitc','vfe']):
+    """
+    Accuracy and timing of the solvers on the same light curve
+
+    Parameters
+    ----------
+    lc : light curve with t, roll, f, and fdtmask columns
+    sigma, length_t, length_roll, sigma_n : hyperparameters
+    solvers : names of solvers to compare. The first one is the
+              reference for the accuracy
+
+    Returns
+    -------
+    comp : DataFrame with one row per solver and columns
+           - time : time to compute and predict [s]
+           - rms_diff : rms difference between the predicted trend and
+             the one of the reference solver
+           - max_diff : maximum absolute difference
+    """
+    lc_gp = lc[~lc.fdtmask]
+    X_gp = np.array(lc_gp[['t','roll']])
+    y_gp = np.array(lc_gp['f'])
+    X = np.array(lc[['t','roll']])
+
+    comp = []
+    for solver in solvers:
+        start = time.time()
+        gp = get_solver(solver, sigma, length_t, length_roll)
+        gp.compute(X_gp, sigma_n)
+        mu = gp.predict(y_gp, X)
+        d = dict(solver=solver, time=time.time() - start)
+        if len(comp)==0:
+            mu_ref = mu
+
+        d['rms_diff'] = np.sqrt(np.mean((mu - mu_ref)**2))
+        d['max_diff'] = np.max(np.abs(mu - mu_ref))
+        print "{solver}: {time:.2f} s, rms diff = {rms_diff:.2e}".format(**d)
+        comp.append(d)
+
+    comp = pd.DataFrame(comp)[['solver','time','rms_diff','max_diff']]
+    return comp
+
+# Names of the hyperparameters, in the order used by log_likelihood
+HYPERPARAMETERS = ['sigma','length_t','length_roll','sigma_n']
+
+def log_likelihood(logp, X, y):
+    """
+    Log marginal likelihood of the GP and its gradient
+
+    Parameters
+    ----------
+    logp : natural log of (sigma, length_t, length_roll, sigma_n)
+    X : n x 2 array of (t, roll)
+    y : length n array of (normalized, zero mean) flux
+
+    Returns
+    -------
+    lnlike : log marginal likelihood
+    grad : gradient of lnlike with respect to logp
+    """
+    sigma, length_t, length_roll, sigma_n = np.exp(logp)
+    X = np.asarray(X, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+
+    Kf = kernel_t_roll(X, X, sigma, length_t, length_roll)
+    K = Kf.copy()
+    K[np.diag_indices(n)] += sigma_n**2
+    try:
+        factor = linalg.cho_factor(K, lower=True)
+    except linalg.LinAlgError:
+        return -np.inf, np.zeros(4)
+
+    alpha = linalg.cho_solve(factor, y)
+    logdet = 2 * np.sum(np.log(np.diag(factor[0])))
+    lnlike = -0.5 * np.dot(y, alpha) - 0.5 * logdet - 0.5 * n * np.log(2*np.pi)
+
+    # dlnlike / dp = 0.5 tr((alpha alpha^T - K^-1) dK / dp)
+    W = np.outer(alpha, alpha) - linalg.cho_solve(factor, np.eye(n))
+    dt2 = (X[:,0,np.newaxis] - X[np.newaxis,:,0])**2 / length_t**2
+    droll2 = (X[:,1,np.newaxis] - X[np.newaxis,:,1])**2 / length_roll**2
+    WKf = W * Kf
+    grad = 0.5 * np.array([
+        2 * np.sum(WKf),
+        np.sum(WKf * dt2),
+        np.sum(WKf * droll2),
+        2 * sigma_n**2 * np.trace(W),
+        ])
+    return lnlike, grad
+
+class TimeBudgetExceeded(Exception):
+    pass
+
+def optimize_hyperparameters(X, y, p0, nmax=500, nstart=4, processes=None,
+                             time_budget=30, seed=0):
+    """
+    Maximize the log marginal likelihood
+
+    The likelihood costs O(n**3), so it is evaluated on at most nmax
+    cadences, taken evenly spaced in time. The optimization (L-BFGS-B
+    with analytic gradients, in log space) is started from p0 and from
+    nstart - 1 random points around it. The starts run concurrently
+    in a pool of threads and all stop once time_budget is used up;
+    the best point found so far is returned.
+
+    Parameters
+    ----------
+    X : n x 2 array of (t, roll) of unmasked cadences
+    y : length n array of normalized flux
+    p0 : initial guess for (sigma, length_t, length_roll, sigma_n)
+    nmax : maximum number of cadences used
+    nstart : number of starting points
+    processes : number of threads, None uses one per CPU
+    time_budget : wall time allowed for the optimization [s]
+    seed : seed for the random starting points
+
+    Returns
+    -------
+    p : best (sigma, length_t, length_roll, sigma_n)
+    lnlike : log marginal likelihood of p (on the subsample)
+    """
+    X = np.asarray(X, dtype=float)
+    y = np.asarray(y, dtype=float)
+    step = int(np.ceil(len(y) / float(nmax)))
+    X = X[::step]
+    y = y[::step]
+
+    logp0 = np.log(p0)
+    rng = np.random.RandomState(seed)
+    # Broad limits (factors of e**5) keep the kernel from degenerating
+    bounds = [(lp - 5, lp + 5) for lp in logp0]
+    starts = [logp0] + [
+        np.clip(logp0 + rng.normal(0, 1, 4), logp0 - 5, logp0 + 5)
+        for i in range(nstart - 1)
+        ]
+    deadline = time.time() + time_budget
+
+    def _optimize(logp_start):
+        best = dict(lnlike=-np.inf, logp=logp_start)
+        def _nll(logp):
+            if time.time() > deadline:
+                raise TimeBudgetExceeded
+
+            lnlike, grad = log_likelihood(logp, X, y)
+            if lnlike > best['lnlike']:
+                best['lnlike'] = lnlike
+                best['logp'] = logp.copy()
+            if not np.isfinite(lnlike):
+                return 1e25, np.zeros(4)
+
+            return -lnlike, -grad
+
+        try:
+            minimize(_nll, logp_start, jac=True, method='L-BFGS-B', bounds=bounds)
+        except TimeBudgetExceeded:
+            print "time budget reached"
+
+        return best
+
+    pool = ThreadPool(processes)
+    results = pool.map(_optimize, starts)
+    pool.close()
+    pool.join()
+
+    best = max(results, key=lambda x : x['lnlike'])
+    p = np.exp(best['logp'])
+    return p, best['lnlike']
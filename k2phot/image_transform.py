@@ -2,6 +2,8 @@
 Module containing code to compute the linear transformation
 between sets of points
 """
+import warnings
+
 import numpy as np
 
 def fit_6_par_trans(x1,y1,x2,y2):
@@ -76,6 +78,140 @@ def fit_6_par_trans(x1,y1,x2,y2):
 
     return TM,x1o,y1o,x2o,y2o
 
+# Per-frame sums over stars needed to solve the six parameter fit
+SUFFSTATS_KEYS = 'n,sx1,sy1,sx2,sy2,sx1x1,sx1y1,sy1y1,sx1x2,sy1x2,sx1y2,sy1y2'
+
+def trans_suffstats(x1,y1,x2,y2,mask=None):
+    """Sufficient statistics of the six parameter fit
+
+    Sums over stars of the positions and their products for every
+    target frame. Statistics computed from disjoint sets of stars
+    can be added (see `add_suffstats`), so stars can be added to a
+    fit without revisiting the old ones.
+
+    Parameters
+    ----------
+    x1, y1 : nstar arrays with positions in the reference frame
+    x2, y2 : nstar x nframe arrays with positions in the target frames
+    mask : [optional] nstar x nframe boolean array. False excludes
+           a star from the fit to that frame. Stars that are nan in
+           either frame are always excluded.
+
+    Returns
+    -------
+    stats : length nframe record array with SUFFSTATS_KEYS fields
+    """
+    x1 = np.asarray(x1, dtype=float)[:,np.newaxis]
+    y1 = np.asarray(y1, dtype=float)[:,np.newaxis]
+    x2 = np.asarray(x2, dtype=float)
+    y2 = np.asarray(y2, dtype=float)
+
+    m = np.isfinite(x1) & np.isfinite(y1) & np.isfinite(x2) & np.isfinite(y2)
+    if mask is not None:
+        m = m & mask
+
+    x1 = np.where(m, x1, 0)
+    y1 = np.where(m, y1, 0)
+    x2 = np.where(m, x2, 0)
+    y2 = np.where(m, y2, 0)
+    arrs = [
+        m.sum(axis=0).astype(float), 
+        x1.sum(axis=0), y1.sum(axis=0), x2.sum(axis=0), y2.sum(axis=0),
+        (x1*x1).sum(axis=0), (x1*y1).sum(axis=0), (y1*y1).sum(axis=0),
+        (x1*x2).sum(axis=0), (y1*x2).sum(axis=0), 
+        (x1*y2).sum(axis=0), (y1*y2).sum(axis=0), 
+    ]
+    stats = np.rec.fromarrays(arrs, names=SUFFSTATS_KEYS)
+    return stats
+
+def add_suffstats(stats1, stats2):
+    """Combine sufficient statistics from two disjoint sets of stars"""
+    keys = SUFFSTATS_KEYS.split(',')
+    arrs = [stats1[k] + stats2[k] for k in keys]
+    return np.rec.fromarrays(arrs, names=SUFFSTATS_KEYS)
+
+def fit_6_par_trans_suffstats(stats):
+    """Solve the six parameter fit from sufficient statistics
+
+    For each frame we build the 2x2 normal equations
+
+        [Sxx Sxy] [A]   [Sxx2]      [Sxx Sxy] [C]   [Sxy2]
+        [Sxy Syy] [B] = [Syx2]      [Sxy Syy] [D] = [Syy2]
+
+    from the centered sums and solve them in closed form.
+
+    Returns
+    -------
+    TM : nframe x 2 x 2 transformation matrices. nan for frames with
+         fewer than 3 usable stars or a degenerate configuration
+    x1o, y1o, x2o, y2o : length nframe arrays of centroids
+    """
+    n = stats['n']
+    nsafe = np.where(n > 0, n, 1)
+
+    # Compute centroids of the points
+    x1o = stats['sx1'] / nsafe
+    y1o = stats['sy1'] / nsafe
+    x2o = stats['sx2'] / nsafe
+    y2o = stats['sy2'] / nsafe
+
+    # Normal equations in terms of displacements from the centroids
+    Sxx = stats['sx1x1'] - n * x1o * x1o
+    Sxy = stats['sx1y1'] - n * x1o * y1o
+    Syy = stats['sy1y1'] - n * y1o * y1o
+    Sxx2 = stats['sx1x2'] - n * x1o * x2o
+    Syx2 = stats['sy1x2'] - n * y1o * x2o
+    Sxy2 = stats['sx1y2'] - n * x1o * y2o
+    Syy2 = stats['sy1y2'] - n * y1o * y2o
+
+    det = Sxx * Syy - Sxy**2
+    good = (n >= 3) & (det > 0)
+    det = np.where(good, det, np.nan)
+
+    TM = np.empty((len(n),2,2))
+    TM[:,0,0] = (Syy * Sxx2 - Sxy * Syx2) / det # A
+    TM[:,0,1] = (Sxx * Syx2 - Sxy * Sxx2) / det # B
+    TM[:,1,0] = (Syy * Sxy2 - Sxy * Syy2) / det # C
+    TM[:,1,1] = (Sxx * Syy2 - Sxy * Sxy2) / det # D
+    return TM,x1o,y1o,x2o,y2o
+
+def fit_6_par_trans_batch(x1,y1,x2,y2,mask=None):
+    """Fit Six Parameter Transformation for many frames at once
+
+    Same model as `fit_6_par_trans`, solved for every target frame
+    simultaneously from the sufficient statistics. Stars that are nan
+    in either frame (or excluded by `mask`) do not contribute to the
+    fit or to the centroids.
+
+    Parameters
+    ----------
+    x1, y1 : nstar arrays with positions in the reference frame
+    x2, y2 : nstar x nframe arrays with positions in the target frames
+    mask : [optional] nstar x nframe boolean array. False excludes
+           a star from the fit to that frame
+
+    Returns
+    -------
+    TM : nframe x 2 x 2 transformation matrices
+    x1o, y1o, x2o, y2o : length nframe arrays of centroids
+    """
+    stats = trans_suffstats(x1,y1,x2,y2,mask=mask)
+    return fit_6_par_trans_suffstats(stats)
+
+def ref_to_targ_batch(x1,y1,TM,x1o,y1o,x2o,y2o):
+    """
+    Reference frame to target frames
+
+    Vectorized version of `ref_to_targ`. x1, y1 are nstar arrays,
+    the transformation parameters are length nframe. Returns nstar
+    x nframe arrays.
+    """
+    dx1 = np.asarray(x1)[:,np.newaxis] - x1o
+    dy1 = np.asarray(y1)[:,np.newaxis] - y1o
+    x2pr = TM[:,0,0] * dx1 + TM[:,0,1] * dy1 + x2o
+    y2pr = TM[:,1,0] * dx1 + TM[:,1,1] * dy1 + y2o
+    return x2pr,y2pr
+
 def fit_6_par_trans_iter(x1,y1,x2,y2,verbose=True):
     nuse0 = len(x1)
     iuse = np.arange(nuse0)
@@ -89,7 +225,7 @@ def fit_6_par_trans_iter(x1,y1,x2,y2,verbose=True):
         x2pr,y2pr = ref_to_targ(x1[iuse],y1[iuse],TM,x1o,y1o,x2o,y2o)
         dist = np.sqrt( (x2pr -x2[iuse] )**2 + (y2pr-y2[iuse])**2 )
         sig = np.median(dist)*1.5
-        iuse = np.where(dist < (sig * thresh))[0]
+        iuse = iuse[dist < (sig * thresh)]
         if verbose:
             print "nout=%i, nin=%i, sig=%.1f millipix" % \
                 (nuse0,len(iuse),1e3*sig)
@@ -100,6 +236,51 @@ def fit_6_par_trans_iter(x1,y1,x2,y2,verbose=True):
 
     return TM,x1o,y1o,x2o,y2o
 
+def fit_6_par_trans_iter_batch(x1,y1,x2,y2,threshL=[5,3],mask=None):
+    """Fit Six Parameter Transformation with Outlier Rejection
+
+    Vectorized version of `fit_6_par_trans_iter`. Every rejection
+    iteration fits all target frames at once through the masked
+    sufficient statistics, so it costs a few passes over the
+    centroid arrays regardless of the number of frames.
+
+    Parameters
+    ----------
+    x1, y1 : nstar arrays with positions in the reference frame
+    x2, y2 : nstar x nframe arrays with positions in the target frames
+    threshL : rejection thresholds in units of 1.5 x the median
+              distance between the observed and transformed positions
+    mask : [optional] nstar x nframe boolean array of stars to consider
+
+    Returns
+    -------
+    TM, x1o, y1o, x2o, y2o : see `fit_6_par_trans_suffstats`
+    mask : nstar x nframe boolean array of stars used in the final fit
+    """
+    x1 = np.asarray(x1, dtype=float)
+    y1 = np.asarray(y1, dtype=float)
+    x2 = np.asarray(x2, dtype=float)
+    y2 = np.asarray(y2, dtype=float)
+    m = np.isfinite(x2) & np.isfinite(y2)
+    m = m & np.isfinite(x1)[:,np.newaxis] & np.isfinite(y1)[:,np.newaxis]
+    if mask is not None:
+        m = m & mask
+
+    for thresh in threshL:
+        TM,x1o,y1o,x2o,y2o = fit_6_par_trans_batch(x1,y1,x2,y2,mask=m)
+        x2pr,y2pr = ref_to_targ_batch(x1,y1,TM,x1o,y1o,x2o,y2o)
+        dist = np.sqrt( (x2pr - x2)**2 + (y2pr - y2)**2 )
+        dist[~m] = np.nan
+
+        # Frames without usable stars give all-nan columns
+        with warnings.catch_warnings(), np.errstate(invalid='ignore'):
+            warnings.simplefilter('ignore', RuntimeWarning)
+            sig = np.nanmedian(dist, axis=0) * 1.5
+            m = m & (dist <= (sig * thresh))
+
+    TM,x1o,y1o,x2o,y2o = fit_6_par_trans_batch(x1,y1,x2,y2,mask=m)
+    return TM,x1o,y1o,x2o,y2o,m
+
 def ref_to_targ(x1,y1,TM,x1o,y1o,x2o,y2o):
     """
     Reference frame to taget frame
@@ -126,7 +307,7 @@ def targ_to_ref(x2,y2,TM,x1o,y1o,x2o,y2o):
     y1pr = xy1pr[1] # predicted y value
     return x1pr,y1pr
 
-def linear_transform(x,y,irf):
+def linear_transform(x,y,irf,return_suffstats=False,robust=True):
     """
     Linear transformation
 
@@ -135,6 +316,8 @@ def linear_transform(x,y,irf):
     x : `x` (column) position of points 
     y : `y` (row) position of points 
     irf : index of the frame to use as reference
+    robust : if True, reject stars that transform badly with
+             `fit_6_par_trans_iter_batch`
 
     Returns
     -------
@@ -147,6 +330,10 @@ def linear_transform(x,y,irf):
             - x,y : original points
             - xpr,ypr : x,y points transformed into target frame given
               the best fit transformation
+
+    suffstats : (if return_suffstats) per-frame sufficient statistics
+                of the fit (rejected points excluded). Allow stars to
+                be added later without recomputing the fit from scratch.
     """
 
     assert x.shape==y.shape,"x and y must have the same dimensions"
@@ -165,34 +352,36 @@ def linear_transform(x,y,irf):
     x1 = x[:,irf]  # column centroids of stars in reference frame
     y1 = y[:,irf]  # row centroids of stars in reference frame
 
-    # itr is index of the target frame
-    for itr in range(ncad):
-        x2 = x[:,itr] # column centroids of stars in target frame
-        y2 = y[:,itr] # row centroids of stars in target frame
-        rp = pnts[:,itr]
-        rt = trans[itr]
-
-        if (~np.isnan(x2)).sum()!=0:
-            TM,x1o,y1o,x2o,y2o = fit_6_par_trans(x1,y1,x2,y2)
-            
-            # Shove the transformation parameters into array
-            rt['A'] = TM[0,0]
-            rt['B'] = TM[0,1]
-            rt['C'] = TM[1,0]
-            rt['D'] = TM[1,1]
-            rt['x1o'] = x1o
-            rt['y1o'] = y1o
-            rt['x2o'] = x2o
-            rt['y2o'] = y2o
-
-            # Shove the transformed points into record array 
-            x2pr,y2pr = ref_to_targ(x1,y1,TM,x1o,y1o,x2o,y2o)
-            rp['x'] = x2        
-            rp['y'] = y2
-            rp['xpr'] = x2pr
-            rp['ypr'] = y2pr
-
-        if itr%1000==0:
-            print itr
+    # Solve for all target frames at once. Frames without a valid
+    # solution are left as zeros.
+    mask = None
+    if robust:
+        mask = fit_6_par_trans_iter_batch(x1,y1,x,y)[-1]
+        nfinite = (np.isfinite(x) & np.isfinite(y)).sum()
+        print "%i/%i points rejected" % (nfinite - mask.sum(), nfinite)
+
+    suffstats = trans_suffstats(x1,y1,x,y,mask=mask)
+    TM,x1o,y1o,x2o,y2o = fit_6_par_trans_suffstats(suffstats)
+    good = np.isfinite(TM).all(axis=2).all(axis=1)
+    print "%i/%i frames with valid transformation" % (good.sum(), ncad)
+
+    # Shove the transformation parameters into array
+    trans['A'][good] = TM[good,0,0]
+    trans['B'][good] = TM[good,0,1]
+    trans['C'][good] = TM[good,1,0]
+    trans['D'][good] = TM[good,1,1]
+    trans['x1o'][good] = x1o[good]
+    trans['y1o'][good] = y1o[good]
+    trans['x2o'][good] = x2o[good]
+    trans['y2o'][good] = y2o[good]
+
+    # Shove the transformed points into record array 
+    x2pr,y2pr = ref_to_targ_batch(x1,y1,TM,x1o,y1o,x2o,y2o)
+    pnts['x'][:,good] = x[:,good]
+    pnts['y'][:,good] = y[:,good]
+    pnts['xpr'][:,good] = x2pr[:,good]
+    pnts['ypr'][:,good] = y2pr[:,good]
+    if return_suffstats:
+        return trans,pnts,suffstats
 
     return trans,pnts
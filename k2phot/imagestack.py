@@ -1,15 +1,19 @@
 import numpy as np
 from numpy import ma
 from scipy.optimize import fmin
-from scipy import ndimage as nd
 from matplotlib import pyplot as plt
 import pandas as pd
 
 from frame import Frame
 import circular_photometry
+import rolling
+import diffimage
 from io_utils.pixel import loadPixelFile, get_wcs
 from circular_photometry import circular_photometry_weights
 
+# Number of frames of difference images computed at once
+diffimage_block = 256
+
 class ImageStack(object):
     def __init__(self, pixfile, tlimits=[-np.inf,np.inf],tex=None):
         """
@@ -26,6 +30,7 @@ class ImageStack(object):
         self.pixfile = pixfile
         self.headers = headers
         self.flux = cube['FLUX'].astype(float)
+        self.flux_err = cube['FLUX_ERR'].astype(float)
         self.t = cube['TIME'].astype(float)
         self.cad = cube['CADENCENO'].astype(int)
 
@@ -38,6 +43,8 @@ class ImageStack(object):
         self.ts = pd.DataFrame(ts)
         self.tlimits = tlimits
         self.ap = None
+        self.fbg = None
+        self.flux_ref = None
 
     def get_xy_from_header(self):
         """
@@ -89,15 +96,120 @@ class ImageStack(object):
         self.ts['fbg'] = self.fbg
         self.ts['bgmask'] = self.bgmask
 
-    def get_sap_flux(self):
+    def set_diffimage(self, dx, dy):
+        """
+        Prepare difference images
+
+        Sets the reference frame (self.flux_ref) and stores the
+        motion. The motion corrected cube (reference plus difference
+        images) is not kept; `get_diff_flux` computes it a block of
+        frames at a time when photometry is requested.
+
+        Parameters
+        ----------
+        dx, dy : per-cadence motion of the stamp [pixels] (see
+                 `diffimage.get_stamp_motion`)
+        """
+        self.diff_dx = np.asarray(dx, dtype=float)
+        self.diff_dy = np.asarray(dy, dtype=float)
+        self.flux_ref = diffimage.reference_frame(
+            self.flux, self.diff_dx, self.diff_dy, block=diffimage_block
+            )
+
+    def get_diff_flux(self, frames):
+        """
+        Motion corrected flux (reference plus difference images)
+
+        Parameters
+        ----------
+        frames : slice of frames
+
+        Returns
+        -------
+        flux : array with the shape of self.flux[frames]
+        """
+        assert self.flux_ref is not None, "call set_diffimage first"
+        resid = diffimage.difference_images(
+            self.flux[frames], self.flux_ref, self.diff_dx[frames], 
+            self.diff_dy[frames]
+            )
+        return self.flux_ref[np.newaxis] + resid
+
+    def _iter_flux(self, use_diffimage):
+        """
+        Background-subtracted flux in blocks of frames
+
+        Yields (frames, flux) with flux a nframe_block x npix array.
+        Without difference imaging there is one block with the whole
+        cube.
+        """
+        if use_diffimage:
+            blocks = [
+                slice(i, i + diffimage_block) 
+                for i in range(0, self.nframe, diffimage_block)
+                ]
+        else:
+            blocks = [slice(0, self.nframe)]
+
+        for frames in blocks:
+            if use_diffimage:
+                flux = self.get_diff_flux(frames)
+            else:
+                flux = self.flux[frames]
+
+            flux = flux.reshape(len(flux),-1)
+            flux = flux - self.fbg[frames,np.newaxis]
+            yield frames, flux
+
+    def get_sap_flux(self, weights=None, use_diffimage=False):
         """
         Get aperture photometry. Subtract background
+
+        Parameters
+        ----------
+        weights : [optional] aperture weights. Either a nrow x ncol
+                  array or a nframe x npix array for apertures that
+                  change every cadence. Defaults to self.ap.weights
+        use_diffimage : if True, use the motion corrected flux (see
+                        `set_diffimage`)
+        """
+        if weights is None:
+            weights = self.ap.weights
+
+        weights = np.asarray(weights).reshape(-1,self.npix)
+        ap_flux = np.zeros(self.nframe)
+        for frames, flux in self._iter_flux(use_diffimage):
+            w = weights
+            if len(weights)==self.nframe:
+                w = weights[frames]
+            _ap_flux = flux * w # flux falling in aperture
+            ap_flux[frames] = np.nansum(_ap_flux,axis=1)
+
+        return ap_flux
+
+    def get_sap_flux_stack(self, weights, use_diffimage=False):
+        """
+        Aperture photometry for many static apertures at once
+
+        Parameters
+        ----------
+        weights : naper x npix stack of aperture weights (see
+                  `apertures.get_weights_stack`)
+        use_diffimage : see `get_sap_flux`
+
+        Returns
+        -------
+        ap_flux : nframe x naper array. Column i equals
+                  get_sap_flux(weights[i])
         """
-        flux = self.flux.copy()
-        flux -= self.fbg[:,np.newaxis,np.newaxis]  
-        ap_flux = flux * self.ap.weights # flux falling in aperture
-        ap_flux = ap_flux.reshape(self.nframe,-1)
-        ap_flux = np.nansum(ap_flux,axis=1)
+        weights = np.asarray(weights).reshape(-1,self.npix)
+        ap_flux = np.zeros((self.nframe, len(weights)))
+        for frames, flux in self._iter_flux(use_diffimage):
+            # Missing pixels do not contribute, as in the nansum of
+            # get_sap_flux
+            flux = np.where(np.isnan(flux), 0, flux)
+            ap_flux[frames] = np.dot(flux, weights.T)
+
         return ap_flux
 
     def get_medframe(self):
@@ -110,6 +222,47 @@ class ImageStack(object):
         flux = np.nanpercentile(self.flux, p, 0)
         flux = ma.masked_invalid(flux)
         return flux
+
+    def get_signal_variance_frames(self):
+        """
+        Signal and variance of every pixel
+
+        The background in each frame is the masked median computed by
+        `set_fbackground`. If it has not been called yet (the aperture
+        that masks the star is what we are building), the background
+        is the median of the pixels that are fainter than the median
+        pixel in the median frame, which excludes the stars. Computed
+        in one pass over the cube.
+
+        Returns
+        -------
+        signal : nrow x ncol median background-subtracted flux
+        variance : nrow x ncol variance in a single frame. Median of
+                   FLUX_ERR**2 plus the cadence-to-cadence variance of
+                   the background estimate
+        """
+        flux = self.flux.reshape(self.nframe,-1)
+        if self.fbg is not None:
+            fbg = self.fbg
+        else:
+            medflux = np.nanmedian(flux, axis=0)
+            bgpix = medflux <= np.nanmedian(medflux)
+            fbg = np.nanmedian(flux[:,bgpix], axis=1)
+
+        signal = np.nanmedian(flux - fbg[:,np.newaxis], axis=0)
+
+        flux_err = self.flux_err.reshape(self.nframe,-1)
+        variance = np.nanmedian(flux_err**2, axis=0)
+
+        # Robust point-to-point scatter in the background
+        dfbg = np.diff(fbg)
+        dfbg = dfbg[np.isfinite(dfbg)]
+        sigma_bg = 1.4826 * np.median(np.abs(dfbg)) / np.sqrt(2)
+        variance += sigma_bg**2
+
+        signal = signal.reshape(self.nrow,self.ncol)
+        variance = variance.reshape(self.nrow,self.ncol)
+        return signal, variance
         
 
 def background_mask(cad,fbg,plot=False):
@@ -157,7 +310,7 @@ def background_mask(cad,fbg,plot=False):
 
     bgmask = (np.abs( fbg - fbgfit ) / np.median(fbg)) > thresh 
     bgresid = fbg - fbgfit
-    bgresidmed = nd.median_filter(bgresid,size=40)
+    bgresidmed = rolling.rolling_median(bgresid,40)
     
     absdiff = np.abs(bgresid - bgresidmed )
     sigbg = 1.5 * np.median(absdiff)
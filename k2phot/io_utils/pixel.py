@@ -9,6 +9,8 @@ from numpy import ma
 import pandas as pd
 import k2_catalogs
 import warnings
+from ..register import register_images
+from .. import synthetic
 
 bitdesc = {
     1 : "Attitude Tweak",
@@ -298,7 +300,8 @@ def get_stars_pix(pixfn,frame, retsynframe=False, ids='all', prfpath=None,dkepma
     frame : reference frame.
     retsynframe : bool; return synthetic frame
     ids : which KIC/EPIC values to include
-    prfpath : filename of PRF file, or None
+    prfpath : directory holding the Kepler PRF files, or None to use
+              a Gaussian PSF
     dkepmag : grab stars upto dkepmag fainter than target
     refine_wcs : Set to true if we want to refine the WCS solution
                     by registering with a synthetic image
@@ -321,11 +324,7 @@ def get_stars_pix(pixfn,frame, retsynframe=False, ids='all', prfpath=None,dkepma
     catcut['pix0'],catcut['pix1'] = pix
 
     if refine_wcs:
-        # Generate a synthetic image
-        # x and y fliped to account for python imshow convention
-        y,x = np.mgrid[0:frame.shape[0],0:frame.shape[1]]
-        synframe = np.zeros(frame.shape)
-        synframe_special = np.zeros(frame.shape)
+        # Generate a synthetic image. All stars are rendered at once.
         catcut['A'] = catcut['kepmag'] - np.min(catcut['kepmag'])
         catcut['A'] = 10**(-0.4 * catcut.A)
 
@@ -334,22 +333,23 @@ def get_stars_pix(pixfn,frame, retsynframe=False, ids='all', prfpath=None,dkepma
         else:
             index = ids
 
+        x = np.array(catcut['pix0'])
+        y = np.array(catcut['pix1'])
+        flux = np.array(catcut['A'])
+        special = np.array(catcut.index.isin(index))
         if prfpath is not None:
-            prf, sampling = loadPRF(file=pixfn)
-            prf = an.pad(prf, frame.shape[0]*sampling, frame.shape[1]*sampling)
-            peakloc = (prf==prf.max()).nonzero()
-
-        for i in catcut.index:
-            d = catcut.ix[i]
-            g = gaussian(d['pix0'],d['pix1'],0.5)
-            if prfpath is not None:
-                prfmod = ld.shiftImages(d['A'] * prf, d['pix0']*sampling-peakloc[0], d['pix1']*sampling-peakloc[1]).squeeze()
-                thisstar = an.binarray(prfmod, sampling)
-            else:
-                thisstar = d['A']*g(x,y)
-            synframe += thisstar
-            if i in index:
-                synframe_special += thisstar
+            prf, sampling = loadPRF(file=pixfn, _prfpath=prfpath)
+            stamps = synthetic.prf_stamps(prf, sampling)
+            render = lambda b : synthetic.render_prf(
+                frame.shape, x[b], y[b], flux[b], stamps
+                )
+        else:
+            render = lambda b : synthetic.render_stars(
+                frame.shape, x[b], y[b], flux[b], sigma=0.5
+                )
+
+        synframe = render(np.ones(len(catcut), dtype=bool))
+        synframe_special = render(special)
 
         scalefactor = frame.sum() / synframe.sum()
         synframe = synframe_special * scalefactor
@@ -357,7 +357,7 @@ def get_stars_pix(pixfn,frame, retsynframe=False, ids='all', prfpath=None,dkepma
 
 
         # Determine the shift between reference and synthetic images
-        shift = register_images(frame, synframe, usfac=100.)
+        shift = register_images(frame, synframe, usfac=100)
         shift = np.array(shift)
 
         if verbose: 
@@ -0,0 +1,88 @@
+"""
+Moving apertures
+
+The spacecraft roll moves stars across the detector by a fraction of
+a pixel between thruster fires. Instead of using a static aperture
+large enough to capture the star at all positions, we shift the
+aperture at every cadence by the measured motion of a representative
+star (`xpr`, `ypr` from the channel transformation).
+"""
+import numpy as np
+import pandas as pd
+
+def get_aperture_motion(trans, cad):
+    """
+    Per-cadence motion of the representative star
+
+    Parameters
+    ----------
+    trans : DataFrame returned by `read_channel_transform`. Must have
+            cad, xpr, and ypr columns
+    cad : cadence numbers of the image stack
+
+    Returns
+    -------
+    dx : displacement along x (column) axis relative to the median
+         position [pixels]. Cadences missing from `trans` are not shifted
+    dy : same along y (row) axis
+    """
+    trans = pd.DataFrame(trans).drop_duplicates(subset=['cad'])
+    trans = trans.set_index('cad')
+    pos = trans[['xpr','ypr']].reindex(np.asarray(cad))
+    pos = pos - pos.median()
+    pos = pos.fillna(0)
+    dx = np.array(pos['xpr'])
+    dy = np.array(pos['ypr'])
+    return dx, dy
+
+def shift_weights(weights, dx, dy):
+    """
+    Shift aperture weights by a different amount at every cadence
+
+    Weights are resampled with bilinear interpolation, so a pixel
+    half covered by the shifted aperture gets half weight. All
+    cadences are computed at once with fancy indexing.
+
+    Parameters
+    ----------
+    weights : nrow x ncol array of aperture weights
+    dx : length ncad array. Shift along x (column) axis [pixels]
+    dy : length ncad array. Shift along y (row) axis [pixels]
+
+    Returns
+    -------
+    weights_cad : ncad x npix array of weights, where npix = nrow * ncol
+    """
+    weights = np.asarray(weights, dtype=float)
+    dx = np.asarray(dx, dtype=float)
+    dy = np.asarray(dy, dtype=float)
+    nrow, ncol = weights.shape
+    ncad = len(dx)
+
+    # Split the shifts into integer and fractional parts
+    ix = np.floor(dx).astype(int)
+    iy = np.floor(dy).astype(int)
+    fx = (dx - ix)[:,np.newaxis,np.newaxis]
+    fy = (dy - iy)[:,np.newaxis,np.newaxis]
+
+    # Pad with zeros so that shifted indecies always fall on the array
+    pad = max(np.abs(ix).max(), np.abs(iy).max()) + 1
+    weights_pad = np.zeros((nrow + 2*pad, ncol + 2*pad))
+    weights_pad[pad:pad+nrow,pad:pad+ncol] = weights
+
+    # Shifted weights at (r, c) are original weights at (r - dy, c - dx)
+    row = np.arange(nrow)[np.newaxis,:] - iy[:,np.newaxis] + pad
+    col = np.arange(ncol)[np.newaxis,:] - ix[:,np.newaxis] + pad
+    row0 = row[:,:,np.newaxis]
+    col0 = col[:,np.newaxis,:]
+    row1 = row0 - 1
+    col1 = col0 - 1
+
+    weights_cad = (
+        (1 - fy) * (1 - fx) * weights_pad[row0,col0] +
+        (1 - fy) * fx * weights_pad[row0,col1] +
+        fy * (1 - fx) * weights_pad[row1,col0] +
+        fy * fx * weights_pad[row1,col1]
+        )
+    weights_cad = weights_cad.reshape(ncad,-1)
+    return weights_cad
@@ -3,6 +3,7 @@ from config import bjd0
 import pandas as pd
 import numpy as np
 from pdplus import LittleEndian
+from apertures import CompactWeights
 import os.path
 from astropy.io.fits import conf
 conf.use_memmap=False
@@ -36,6 +37,12 @@ _COLDEFS_AP_NOISE = [
     ["value","D","Value","ppm"],
 ]
 
+# Column definitions for sparse aperture weights
+_COLDEFS_AP_WEIGHTS_SPARSE = [
+    ["index","J","Flattened (row-major) index of pixel",""],
+    ["weight","D","Aperture weight of pixel",""],
+]
+
 # Column definitions that are specific to a given aperture
 _COLDEFS_VERTS = [
     ["x","D","column of aperture vertex","pixels"],
@@ -62,11 +69,14 @@ class Photometry(object):
     :param lc: Light curve. Every cadence has a measurement
     :type lc: Pandas DataFrame
     
-    :param ap_weights: Mask used to compute static aperture
-    :type ap_weights: NxM array 
+    :param ap_weights: Mask used to compute static aperture. Stored
+                       in compact form, decoded on access.
+    :type ap_weights: NxM array or apertures.CompactWeights
 
-    :param ap_verts: Verticies of apertures (used for plotting)
-    :type ap_verts: Pandas DataFrame
+    :param ap_verts: Verticies of apertures (used for plotting). May
+                     also be a function returning the vertices, which
+                     is only called when they are first needed.
+    :type ap_verts: Pandas DataFrame or callable
 
     :param noise: Noise statistics for given aperture
     :type noise: Pandas DataFrame
@@ -92,6 +102,26 @@ class Photometry(object):
         self.extra_header = extra_header
         self.header = fits.open(self.pixfn)[0].header
 
+    @property
+    def ap_weights(self):
+        return self._ap_weights.to_dense()
+
+    @ap_weights.setter
+    def ap_weights(self, ap_weights):
+        if not isinstance(ap_weights, CompactWeights):
+            ap_weights = CompactWeights(ap_weights)
+        self._ap_weights = ap_weights
+
+    @property
+    def ap_verts(self):
+        if callable(self._ap_verts):
+            self._ap_verts = self._ap_verts()
+        return self._ap_verts
+
+    @ap_verts.setter
+    def ap_verts(self, ap_verts):
+        self._ap_verts = ap_verts
+
     def name_mag(self):
         """Return formatted name and magnitdue"""
         return "{OBJECT},KEPMAG={KEPMAG:.1f}".format(**self.header)
@@ -116,7 +146,7 @@ class Photometry(object):
         hdu_medframe.header['EXTNAME'] = 'medframe'
         
         # HDU that holds aperture weights 
-        hdu_ap_weights = fits.ImageHDU(data=self.ap_weights)
+        hdu_ap_weights = _CompactWeights_to_HDU(self._ap_weights)
         hdu_ap_weights.header['EXTNAME'] = extname( group, 'ap-weights')
 
         # HDU that holds aperture verticies
@@ -211,7 +241,7 @@ def read_fits(*args):
     hdu_ap_lc = hduL[extname( group, 'lc')]
 
     medframe = hdu_medframe.data
-    ap_weights = hdu_ap_weights.data
+    ap_weights = _HDU_to_CompactWeights(hdu_ap_weights)
     ap_verts = hdu_to_DataFrame( hdu_ap_verts )
     lc_shared = hdu_to_DataFrame( hdu_lc_shared )
     ap_lc = hdu_to_DataFrame( hdu_ap_lc )
@@ -231,6 +261,52 @@ def read_fits(*args):
     phot.header_medframe = hdu_medframe.header
     return phot
 
+def _CompactWeights_to_HDU(weights):
+    """
+    Convert compact aperture weights into HDU
+
+    Bit-packed masks are stored as a uint8 image, sparse weights as a
+    binary table of (index, weight) pairs. APENCODE records the
+    encoding and APNROW, APNCOL the shape of the aperture.
+    """
+    if weights.encoding=='bitpack':
+        hdu = fits.ImageHDU(data=weights.data)
+    elif weights.encoding=='sparse':
+        df = pd.DataFrame(weights.data)
+        hdu = _DataFrame_to_BinTableHDU(df, _COLDEFS_AP_WEIGHTS_SPARSE)
+    else:
+        assert False, "encoding must be bitpack or sparse"
+
+    hdu.header['APENCODE'] = (weights.encoding, 'Encoding of aperture weights')
+    hdu.header['APNROW'] = (weights.shape[0], 'Number of rows in aperture')
+    hdu.header['APNCOL'] = (weights.shape[1], 'Number of columns in aperture')
+    return hdu
+
+def _HDU_to_CompactWeights(hdu):
+    """
+    Convert HDU into compact aperture weights. HDUs written before
+    the compact encoding hold the full image of weights.
+    """
+    header = hdu.header
+    if 'APENCODE' not in header:
+        return CompactWeights(hdu.data)
+
+    weights = CompactWeights()
+    weights.encoding = header['APENCODE']
+    weights.shape = (header['APNROW'], header['APNCOL'])
+    if weights.encoding=='bitpack':
+        weights.data = np.array(hdu.data, dtype=np.uint8)
+    elif weights.encoding=='sparse':
+        df = hdu_to_DataFrame(hdu)
+        weights.data = np.rec.fromarrays(
+            [np.array(df['index'], dtype=np.int32), np.array(df['weight'])],
+            names='index,weight'
+            )
+    else:
+        assert False, "encoding must be bitpack or sparse"
+
+    return weights
+
 # Covenience functions to facilitate fits writing
 def _DataFrame_to_Column(df,coldef):
     """
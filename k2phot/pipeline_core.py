@@ -15,6 +15,11 @@ import batman
 import phot
 import imagestack 
 import apertures
+import moving_aperture
+import diffimage
+import crowding
+import synthetic
+from io_utils.pixel import get_stars_pix, loadPRF
 from lightcurve import Lightcurve, Normalizer
 from channel_transform import read_channel_transform
 from ses import total_precision_theory
@@ -51,6 +56,10 @@ class Pipeline(object):
     ]
     # Small, med, and large apertures 
     DEFAULT_AP_RADII = [1.5, 3, 8] 
+    # Directory holding the Kepler PRF files. If set, contamination is
+    # computed with the PRF, otherwise with a Gaussian PSF of width
+    # crowding.psf_sigma
+    prfpath = None
 
     def __init__(self, pixfn, lcfn, transfn, tlimits=[-np.inf,np.inf], 
                  tex=None, plot_backend='.png', aper_custom=None, xy=None,
@@ -62,12 +71,14 @@ class Pipeline(object):
         self.plot_backend = plot_backend
 
         self.kepmag = hduL[0].header['KEPMAG']
+        self.epic = hduL[0].header['KEPLERID']
         self.basename = os.path.splitext(lcfn)[0]
         self.starname = os.path.basename(self.basename)
         self.im_header = hduL[1].header
         self.aper_custom = aper_custom
         self.transitParams = transitParams
         self.transitArgs = transitArgs
+        self.sap_mode = 'static'
 
         # Define skeleton light curve. This pandas DataFrame contains all
         # the columns that don't depend on which aperture is used.
@@ -97,30 +108,104 @@ class Pipeline(object):
         
     def get_aperture(self, ap_type, npix):
         """Convenience function for defining apertures"""
+        if ap_type=='optimal':
+            # Recompute once the masked background of set_fbackground
+            # is available
+            if getattr(self, '_ap_fbg', False) is not self.im.fbg:
+                self.ap_signal, self.ap_variance = \
+                    self.im.get_signal_variance_frames()
+                self._ap_fbg = self.im.fbg
+            ap = apertures.Aperture(
+                self.ap_signal, self.im_header, self.x, self.y, ap_type, 
+                npix, variance=self.ap_variance
+                )
+            return ap
+
         ap = apertures.Aperture(
             self.ap_im, self.im_header, self.x, self.y, ap_type, npix
             )
         return ap
         
-    def set_lc0(self, ap_type, npix):
+    def get_sap_flux(self, ap):
+        """
+        Simple aperture photometry using aperture `ap`
+
+        If `sap_mode` is 'moving', the aperture is shifted at every
+        cadence by the measured motion of the representative star. If
+        `sap_mode` is 'diffimage', the photometry is computed on the
+        motion-corrected difference images (see `diffimage`).
+        """
+        self.im.ap = ap
+        weights = None
+        if self.sap_mode=='moving':
+            weights = moving_aperture.shift_weights(
+                ap.weights, self.ap_dx, self.ap_dy
+                )
+        if self.sap_mode=='diffimage':
+            return self.im.get_sap_flux(use_diffimage=True)
+
+        return self.im.get_sap_flux(weights=weights)
+
+    def get_sap_flux_stack(self, aps):
+        """
+        Simple aperture photometry for many apertures
+
+        Static and difference-image photometry of all apertures is
+        computed with one matrix product. Moving apertures are done
+        one at a time.
+
+        :param aps: apertures
+        :type aps: list of Aperture objects
+
+        :returns: ncad x naper array
+        """
+        if self.sap_mode=='moving':
+            return np.array([self.get_sap_flux(ap) for ap in aps]).T
+
+        weights = apertures.get_weights_stack(aps)
+        return self.im.get_sap_flux_stack(
+            weights, use_diffimage=(self.sap_mode=='diffimage')
+            )
+
+    def set_lc0(self, ap_type, npix, sap_mode=None):
         """
         Set Skeleton Lightcurve
 
         :param r0: radius of aperture used to create skeleton light curve
         :type r0: float
+
+        :param sap_mode: How apertures are placed. `static` uses the
+            same aperture for all cadences. `moving` shifts the
+            aperture at every cadence to follow the motion from the
+            channel transformation. `diffimage` subtracts a reference
+            frame shifted with the channel transformation and
+            measures the residuals. None keeps the current mode.
+        :type sap_mode: str
         """
+        if sap_mode is not None:
+            assert ['static','moving','diffimage'].count(sap_mode)==1, \
+                "sap_mode must be static, moving, or diffimage"
+            self.sap_mode = sap_mode
+
         # Define skeleton light-curve
         # Include pixel transformation information 
-        self.im.ap = apertures.Aperture(
-            self.ap_im, self.im_header, self.x, self.y, ap_type, npix
-            )
+        self.im.ap = self.get_aperture(ap_type, npix)
         self.im.set_fbackground()
 
         lc = self.im.ts 
         trans, pnts = read_channel_transform(self.transfn)
         trans['roll'] = trans['theta'] * 2e5
-
-        lc['fsap'] = self.im.get_sap_flux()
+        self.ap_dx, self.ap_dy = moving_aperture.get_aperture_motion(
+            trans, self.im.cad
+            )
+        if self.sap_mode=='diffimage' and self.im.flux_ref is None:
+            # Chip coordinates of the stamp center
+            col = self.im_header['1CRV4P'] - 1 + 0.5 * (self.im.ncol - 1)
+            row = self.im_header['2CRV4P'] - 1 + 0.5 * (self.im.nrow - 1)
+            dx, dy = diffimage.get_stamp_motion(trans, self.im.cad, col, row)
+            self.im.set_diffimage(dx, dy)
+
+        lc['fsap'] = self.get_sap_flux(self.im.ap)
         #import pdb; pdb.set_trace() 
         #################################################
         # IJMC_edits
@@ -176,6 +261,11 @@ class Pipeline(object):
 
         aper = d['aper']
         _phot = self.detrend(aper)
+        return self._set_dfaper_row(d, _phot)
+
+    def _set_dfaper_row(self, d, _phot):
+        """Store the photometry of aperture d['aper'] and its noise in d"""
+        aper = d['aper']
         ap_noise = _phot.ap_noise
         ap_noise.index = ap_noise.name
 
@@ -210,6 +300,42 @@ class Pipeline(object):
             dfaper[i] = self._detrend_dfaper_row(dfaper_row)
         return dfaper
 
+    def set_stars(self):
+        """
+        Query the catalog for stars in the stamp. Used to estimate
+        crowding.
+        """
+        self.stars, shift = get_stars_pix(
+            self.pixfn, self.medframe, prfpath=self.prfpath
+            )
+
+    def add_contamination(self, dfaper):
+        """
+        Add contamination from neighboring stars to each row of dfaper
+
+        All apertures are evaluated at once from their stacked
+        weights. Adds `contam` (fraction of aperture flux from
+        neighbors) and `dilution` (factor by which transit depths are
+        diluted) to each row.
+        """
+        if not hasattr(self, 'stars'):
+            self.set_stars()
+
+        prf = None
+        if self.prfpath is not None:
+            prf = synthetic.prf_stamps(
+                *loadPRF(file=self.pixfn, _prfpath=self.prfpath)
+                )
+
+        weights = apertures.get_weights_stack([d['aper'] for d in dfaper])
+        crowd = crowding.contamination(
+            self.stars, self.epic, self.medframe.shape, weights, prf=prf
+            )
+        for d, contam, dilution in zip(dfaper, crowd.contam, crowd.dilution):
+            d['contam'] = contam
+            d['dilution'] = dilution
+        return dfaper
+
     def aperture_polish_iteration(self,dfaper0):
         dfaper = copy.deepcopy(dfaper0)
 
@@ -305,6 +431,21 @@ class Pipeline(object):
         aper = self.get_aperture('region', npix)
         return aper
 
+    def get_dfaper_optimal(self):
+        """
+        Return dfaper with a single S/N-optimal aperture
+
+        The support of the aperture is generous (npix_scan_fac times
+        the size expected from the Kepler magnitude) since low S/N
+        pixels get small weights. This avoids the aperture scan.
+        """
+        npix = kepmag_to_npix(self.kepmag) * npix_scan_fac
+        npix = max(np.round(npix), npix_scan_min)
+        aper = self.get_aperture('optimal', npix)
+        d = self._get_dfaper_row(aper=aper)
+        d['to_fits'] = True
+        return [d]
+
 
     def get_diagnostic_info(self, d):
         sdisp = "starname=%s " % self.starname
@@ -397,6 +538,9 @@ class Pipeline(object):
     def to_fits(self, lcfn):
         dfaper = self.dfaper
         print "saving to {}".format(lcfn) 
+
+        # Only the persisted apertures need vertices. Compute them together
+        apertures.compute_verts(list(dfaper[dfaper.to_fits].aper))
         for i,row in dfaper[dfaper.to_fits].iterrows():
             print "saving to {}".format(row.fits_group) 
             row.phot.to_fits(lcfn,row.fits_group)
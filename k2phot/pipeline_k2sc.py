@@ -70,7 +70,7 @@ class PipelineK2SC(Pipeline):
         lc['fdt_t_rollmed'] = lc['fsap'] - lc['ftnd_t_rollmed'] + fsapmed
         noise = self.get_noise(lc)
         _phot = phot.Photometry(
-            self.medframe, lc, ap.weights, ap.verts, noise, pixfn=self.pixfn
+            self.medframe, lc, ap.compact_weights, ap.get_verts, noise, pixfn=self.pixfn
             )
         return _phot
 
@@ -137,22 +137,40 @@ class PipelineK2SC(Pipeline):
    
 def run(pixfn, lcfn, transfn, splits, tlimits=[-np.inf,np.inf], tex=None, 
              debug=False,plot_backend='.png', aper_custom=None,xy=None,
-             transitParams=None, transitArgs=None):
+             transitParams=None, transitArgs=None, sap_mode='static',
+             crowding=False, ap_select='scan'):
     """
     Run the pixel decorrelation on pixel file
+
+    If crowding is True, the optimal aperture minimizes the noise
+    times the dilution from neighboring catalog stars.
+
+    ap_select sets how the optimum aperture is chosen. 'scan' detrends
+    a range of region apertures and keeps the least noisy. 'optimal'
+    uses a single S/N-optimal weighted aperture (see
+    `Pipeline.get_dfaper_optimal`) and skips the scan.
     """
+    assert ['scan','optimal'].count(ap_select)==1, \
+        "ap_select must be scan or optimal"
 
     pipe = PipelineK2SC(
         pixfn,lcfn,transfn,splits,tlimits=tlimits, plot_backend=plot_backend,
         tex=tex, aper_custom=aper_custom,xy=xy, transitParams=transitParams, transitArgs=transitArgs 
     )
     pipe.debug = debug
+    pipe.sap_mode = sap_mode
 
     # Perform hyper parameter optimization using the best guess aperture
     ap = pipe.get_aperture_guess()
     pipe.k2sc(ap)
 
-    if aper_custom is None:
+    if aper_custom is None and ap_select=='optimal':
+        # Photometry with circular apertures and one optimal aperture
+        dfaper = pipe.get_dfaper_default() + pipe.get_dfaper_optimal()
+        dfaper = pipe.aperture_scan(dfaper)
+        dfaper = pd.DataFrame(dfaper)
+        idx = dfaper[dfaper.fits_group.str.contains('optimal')].index[0]
+    elif aper_custom is None:
         # Photometry with circular apertures
         dfaper_default = pipe.get_dfaper_default()
         dfaper_default = pipe.aperture_scan(dfaper_default)
@@ -164,8 +182,14 @@ def run(pixfn, lcfn, transfn, splits, tlimits=[-np.inf,np.inf], tex=None,
 
         # Find optimal region aperture
         dfaper = dfaper_default + dfaper_scan
+        if crowding:
+            dfaper = pipe.add_contamination(dfaper)
         dfaper = pd.DataFrame(dfaper)
-        idx = dfaper[dfaper.fits_group.str.contains('region')].noise.idxmin()
+        selectkey = 'noise'
+        if crowding:
+            dfaper['noise_crowding'] = dfaper.noise * dfaper.dilution
+            selectkey = 'noise_crowding'
+        idx = dfaper[dfaper.fits_group.str.contains('region')][selectkey].idxmin()
     else:
         # Photometry with circular apertures
         dfaper = pipe.get_dfaper_custom()
@@ -5,6 +5,7 @@ import numpy as np
 import pandas as pd
 
 import pixdecor
+import gpsolvers
 import phot
 import plotting
 from pipeline_core import Pipeline, white_noise_estimate
@@ -23,10 +24,27 @@ class PipelinePixDecor(Pipeline):
     :param tranfn: path to pixel file
     :type tranfn: str
     """
-    def set_hyperparameters(self):
+    # GP solver used for detrending, see `gpsolvers`
+    gp_solver = 'dense'
+    # Threads used to detrend the segments during outlier rejection.
+    # Each thread holds its own GP factorization. None uses one per CPU
+    segment_processes = 1
+
+    def set_hyperparameters(self, optimize=False, time_budget=30, nmax=500):
         """
         Sets the hyperparameters using information from the skeleton
         lightcurve
+
+        :param optimize: If True, start from the default values and
+            maximize the GP likelihood of the skeleton light curve
+            (see `gpsolvers.optimize_hyperparameters`)
+        :type optimize: bool
+
+        :param time_budget: wall time allowed for the optimization [s]
+        :type time_budget: float
+
+        :param nmax: number of cadences used to evaluate the likelihood
+        :type nmax: int
         """
         tchunk = 10 # split lightcurve in to tchunk-day long segments
         self.sigma_n = white_noise_estimate(self.kepmag)
@@ -36,6 +54,19 @@ class PipelinePixDecor(Pipeline):
         self.sigma = np.median(sigma)
         self.length_t = 4
         self.length_roll = 10
+        if not optimize:
+            return
+
+        lc = self.lc0[~self.lc0.fdtmask]
+        p0 = [self.sigma, self.length_t, self.length_roll, self.sigma_n]
+        p, lnlike = gpsolvers.optimize_hyperparameters(
+            np.array(lc[['t','roll']]), np.array(lc['f']), p0, nmax=nmax,
+            time_budget=time_budget
+            )
+        self.sigma, self.length_t, self.length_roll, self.sigma_n = p
+        print "optimized hyperparameters (lnlike = {:.1f})".format(lnlike)
+        print "sigma, length_t, length_roll, sigma_n"
+        print self.sigma, self.length_t, self.length_roll, self.sigma_n
 
     def reject_outliers(self):
         """
@@ -45,23 +76,26 @@ class PipelinePixDecor(Pipeline):
         # Set the values of the GP hyper parameters
         lc = pixdecor.detrend_t_roll_2D_segments( 
             self.lc0, self.sigma, self.length_t, self.length_roll,self.sigma_n,
-            reject_outliers=True, segment_length=20
+            reject_outliers=True, segment_length=20, solver=self.gp_solver,
+            processes=self.segment_processes
             )
         self.fdtmask = lc['fdtmask'].copy() 
 
     def detrend(self, ap):
         # Create new lightcurve from skeleton
         lc = self.lc0.copy()
-        self.im.ap = ap
-        lc['fsap'] = self.im.get_sap_flux()
+        lc['fsap'] = self.get_sap_flux(ap)
         norm = Normalizer(lc['fsap'].median()) 
         lc['f'] = norm.norm(lc['fsap'])        
         lc['fdtmask'] = self.fdtmask 
         lc = pixdecor.detrend_t_roll_2D( 
             lc, self.sigma, self.length_t, self.length_roll,self.sigma_n, 
-            reject_outliers=False
+            reject_outliers=False, solver=self.gp_solver, cache=True
             )
+        return self._get_phot(ap, lc, norm)
 
+    def _get_phot(self, ap, lc, norm):
+        """Un-normalize a detrended light curve and wrap it in Photometry"""
         # Un-normalize the data
         for k in self.unnormkeys:
             lc[k] = norm.unnorm(lc[k])
@@ -69,10 +103,42 @@ class PipelinePixDecor(Pipeline):
         noise = self.get_noise(lc)
 
         _phot = phot.Photometry(
-            self.medframe, lc, ap.weights, ap.verts, noise, pixfn=self.pixfn
+            self.medframe, lc, ap.compact_weights, ap.get_verts, noise, pixfn=self.pixfn
             )
         return _phot
 
+    def aperture_scan(self, dfaper):
+        """
+        Detrend all apertures in dfaper at once
+
+        The photometry of all apertures is computed together and the
+        light curves are detrended with a single multi-column GP solve
+        (see `pixdecor.detrend_t_roll_2D_multi`), so each extra
+        aperture costs little more than its photometry.
+        """
+        aps = [d['aper'] for d in dfaper]
+        fsap = self.get_sap_flux_stack(aps)
+        fmed = np.median(fsap, axis=0)
+        lc0 = self.lc0.copy()
+        lc0['fdtmask'] = self.fdtmask 
+        dt = pixdecor.detrend_t_roll_2D_multi(
+            lc0, fsap / fmed - 1, self.sigma, self.length_t, self.length_roll,
+            self.sigma_n, solver=self.gp_solver, cache=True
+            )
+
+        for i, d in enumerate(dfaper):
+            lc = lc0.copy()
+            norm = Normalizer(fmed[i])
+            lc['fsap'] = fsap[:,i]
+            lc['f'] = norm.norm(lc['fsap'])
+            for k in dt.keys():
+                lc[k] = dt[k][:,i]
+
+            _phot = self._get_phot(d['aper'], lc, norm)
+            dfaper[i] = self._set_dfaper_row(d, _phot)
+
+        return dfaper
+
     def noise_aperture(self, npix, dfaper):
         """
         Noise for different pixel sizes
@@ -101,31 +167,40 @@ class PipelinePixDecor(Pipeline):
         return d['noise']
 
 def run(pixfn, lcfn, transfn, tlimits=[-np.inf,np.inf], tex=None, 
-             debug=False, ap_select_tlimits=None):
+             debug=False, ap_select_tlimits=None, gp_solver='dense',
+             optimize_gp=False, gp_time_budget=30):
     """
     Run the pixel decorrelation on pixel file
+
+    If optimize_gp is True, the GP hyperparameters are fit to the
+    skeleton light curve, taking at most gp_time_budget seconds.
     """
 
     pipe = PipelinePixDecor(
            pixfn, lcfn,transfn, tlimits=tlimits, tex=None
            )
+    pipe.gp_solver = gp_solver
     
     pipe.print_parameters()
     pipe.set_lc0('circular',10)
-    pipe.set_hyperparameters()
+    pipe.set_hyperparameters(optimize=optimize_gp, time_budget=gp_time_budget)
     pipe.reject_outliers()
 
-    dfaper = pipe.get_dfaper_default()
-    dfaper = pipe.detrend_dfaper(dfaper)
-    dfaper_optimize = pipe.optimize_aperture()
-    dfaper = dfaper + dfaper_optimize
-    dfaper = pd.DataFrame(dfaper)
-    row = dfaper.loc[dfaper.noise.idxmin()].copy()
+    # Circular and region apertures are detrended together in one
+    # multi-column GP solve, then the best region aperture is refined
+    dfaper_default = pipe.get_dfaper_default()
+    dfaper_scan = pipe.get_dfaper_scan()
+    dfaper = pipe.aperture_scan(dfaper_default + dfaper_scan)
+    dfaper_default = dfaper[:len(dfaper_default)]
+    dfaper_scan = pipe.aperture_polish(dfaper[len(dfaper_default):])
+    dfaper = pd.DataFrame(dfaper_default + dfaper_scan)
+    idx = dfaper[dfaper.fits_group.str.contains('region')].noise.idxmin()
+    row = dfaper.loc[idx].copy()
     row['to_fits'] = True
     row['fits_group'] = 'optimum'
     dfaper = dfaper.append(row, ignore_index=True)
     pipe.dfaper = dfaper
-    print dfaper.sort('npix')['fits_group npix noise to_fits'.split()]
+    print dfaper.sort_values(by='npix')['fits_group npix noise to_fits'.split()]
     pipe.to_fits(pipe.lcfn)
 
     if 0:
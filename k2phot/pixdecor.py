@@ -1,19 +1,21 @@
 from cStringIO import StringIO as sio
 import os
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 from numpy import ma
 import pandas as pd
-import george
 
 from pdplus import LittleEndian
 from matplotlib import pylab as plt
 import apertures
+import gpsolvers
 
 os.system('echo "pixel_decorrelation modules loaded:" $(date) ')
 
 def detrend_t_roll_2D(lc, sigma, length_t, length_roll, sigma_n, 
-                      reject_outliers=False,debug=False):
+                      reject_outliers=False,debug=False,solver='dense',
+                      cache=False, return_var=False):
     """
     Detrend against time and roll angle. Hyperparameters are passed
     in as arguments. Option for iterative outlier rejection.
@@ -25,6 +27,15 @@ def detrend_t_roll_2D(lc, sigma, length_t, length_roll, sigma_n,
     length_roll : length scale [arcsec] of GP covariance
     sigma_n : amount of white noise
     reject_outliers : True, reject outliers using iterative sigma clipping
+    solver : GP solver, 'dense', 'hodlr', 'fitc', or 'vfe'. See
+             `gpsolvers`
+    cache : True, reuse the GP factorization of the previous call if
+            the hyperparameters and unmasked cadences are the same.
+            Useful when detrending many apertures of the same star.
+            Not used with reject_outliers
+    return_var : True, also compute the predictive standard deviation
+                 of the trend (column ftnd_t_roll_2D_err). Only the
+                 diagonal of the predictive covariance is computed
 
     Returns 
     -------
@@ -61,18 +72,32 @@ def detrend_t_roll_2D(lc, sigma, length_t, length_roll, sigma_n,
 
         # suffix _gp means that it's used for the training
         # no suffix means it's used for the full run
-        lc_gp = lc[~lc.fdtmask] 
-
-        # Define the GP
-        kernel = sigma**2 * george.kernels.ExpSquaredKernel(
-            [length_t**2,length_roll**2],ndim=2
-            ) 
-
-        gp = george.GP(kernel)
-        gp.compute(lc_gp[Xkey],sigma_n)
+        # The GP is factorized once, on the cadences unmasked at
+        # iteration 0. Clipped outliers are then removed from the
+        # factorization (downdated) instead of starting over
+        if iteration==0:
+            lc_gp = lc[~fdtmask] 
+            if cache and maxiter==1:
+                gp = gpsolvers.get_cached_solver(
+                    solver, sigma, length_t, length_roll, sigma_n, 
+                    np.array(lc_gp[Xkey])
+                    )
+            else:
+                gp = gpsolvers.get_solver(solver, sigma, length_t, length_roll)
+                gp.compute(np.array(lc_gp[Xkey]),sigma_n)
+        else:
+            gp.downdate(np.array(lc.fdtmask)[~fdtmask])
+            lc_gp = lc[~fdtmask] 
 
         # Detrend againts time and roll angle
-        mu,cov = gp.predict(lc_gp[Ykey],lc[Xkey])
+        if return_var:
+            mu, var = gp.predict(
+                np.array(lc_gp[Ykey]), np.array(lc[Xkey]), return_var=True
+                )
+            lc[ftndkey+'_err'] = np.sqrt(var)
+        else:
+            mu = gp.predict(np.array(lc_gp[Ykey]),np.array(lc[Xkey]))
+
         lc[ftndkey] = mu
         lc[fdtkey] = lc[Ykey] - lc[ftndkey]
 
@@ -80,7 +105,7 @@ def detrend_t_roll_2D(lc, sigma, length_t, length_roll, sigma_n,
         medroll = np.median( lc['roll'] ) 
         X_t_rollmed = lc[Xkey].copy()
         X_t_rollmed['roll'] = medroll
-        mu,cov = gp.predict(lc_gp[Ykey],X_t_rollmed)
+        mu = gp.predict(np.array(lc_gp[Ykey]),np.array(X_t_rollmed))
         lc['ftnd_t_rollmed'] = mu
         lc['fdt_t_rollmed'] = lc[fdtkey] + mu
         iteration+=1
@@ -102,21 +127,85 @@ def detrend_t_roll_2D(lc, sigma, length_t, length_roll, sigma_n,
 
     return lc
 
+def detrend_t_roll_2D_multi(lc, flux, sigma, length_t, length_roll, sigma_n,
+                            solver='dense', cache=False):
+    """
+    Detrend many light curves against time and roll angle at once
+
+    All light curves share the cadences, (t, roll), training mask
+    (lc.fdtmask), and hyperparameters, so the GP is factorized once
+    and all columns are solved together.
+
+    Parameters
+    ----------
+    lc : light curve with t, roll, and fdtmask columns
+    flux : ncad x nlc array of normalized fluxes, e.g. one column per
+           aperture
+    sigma, length_t, length_roll, sigma_n : see `detrend_t_roll_2D`
+    solver : GP solver, see `gpsolvers`
+    cache : reuse the factorization of the previous call if possible
+
+    Returns
+    -------
+    dt : dict of ncad x nlc arrays with the keys ftnd_t_roll_2D,
+         fdt_t_roll_2D, ftnd_t_rollmed, and fdt_t_rollmed (same
+         meaning as the columns added by `detrend_t_roll_2D`)
+    """
+    Xkey = 't roll'.split()
+    flux = np.asarray(flux, dtype=float)
+    assert flux.shape[0]==len(lc), "flux must have one row per cadence"
+
+    fdtmask = np.array(lc.fdtmask)
+    X = np.array(lc[Xkey])
+    X_gp = X[~fdtmask]
+    if cache:
+        gp = gpsolvers.get_cached_solver(
+            solver, sigma, length_t, length_roll, sigma_n, X_gp
+            )
+    else:
+        gp = gpsolvers.get_solver(solver, sigma, length_t, length_roll)
+        gp.compute(X_gp, sigma_n)
+
+    X_rollmed = X.copy()
+    X_rollmed[:,1] = np.median(lc['roll'])
+
+    dt = {}
+    dt['ftnd_t_roll_2D'] = gp.predict(flux[~fdtmask], X)
+    dt['fdt_t_roll_2D'] = flux - dt['ftnd_t_roll_2D']
+    dt['ftnd_t_rollmed'] = gp.predict(flux[~fdtmask], X_rollmed)
+    dt['fdt_t_rollmed'] = dt['fdt_t_roll_2D'] + dt['ftnd_t_rollmed']
+    return dt
+
 def detrend_t_roll_2D_segments(*args,**kwargs):
     """
     Simple wrapper around detrend_t_roll_2D
 
+    The segments are independent and can be detrended concurrently in
+    a pool of threads (the work is in BLAS/LAPACK calls, which release
+    the GIL). Each thread holds its own GP factorization, so memory
+    grows with the number of threads. Results are stitched back in
+    time order, so the output does not depend on the number of
+    threads.
+
     Parameters
     ----------
     segment_length : approximate time for the segments [days]
+    processes : number of threads. Default 1 runs the segments
+                serially, None uses one per CPU
+    overlap : each segment is extended by overlap/2 days on both
+              sides. Where segments overlap, the trends (and their
+              uncertainties, if computed) are cross-faded with linear
+              weights, which removes steps at the segment boundaries
+              [days]
     
     Returns
     -------
     lc : lightcurve after being stiched back together
     """
     lc = args[0]
-    segment_length = kwargs['segment_length']
-    kwargs.pop('segment_length')
+    segment_length = kwargs.pop('segment_length')
+    processes = kwargs.pop('processes', 1)
+    overlap = kwargs.pop('overlap', 0)
     nchunks = lc['t'].ptp() / segment_length 
     nchunks = int(nchunks)
     nchunks = max(nchunks,1)
@@ -124,15 +213,62 @@ def detrend_t_roll_2D_segments(*args,**kwargs):
         args_segment = (lc,) + args[1:]
         return detrend_t_roll_2D(*args_segment,**kwargs)
 
-    lc_segments = np.array_split(lc,nchunks)
-    lc_out = []
-    for i,lc in enumerate(lc_segments):
-        args_segment = (lc,) + args[1:]
-        lc_out+=[detrend_t_roll_2D(*args_segment,**kwargs)]
+    # Cadences that each segment is responsible for (core) and the
+    # cadences it is trained on (core plus the overlap)
+    t = np.array(lc['t'])
+    cores = np.array_split(np.arange(len(lc)), nchunks)
+    tbounds = [0.5 * (t[c0[-1]] + t[c1[0]]) for c0, c1 in zip(cores[:-1], cores[1:])]
+    tbounds = np.array([-np.inf] + tbounds + [np.inf])
+    segments = []
+    for i in range(nchunks):
+        if overlap==0:
+            segments.append(cores[i])
+            continue
 
+        inseg = (t > tbounds[i] - 0.5 * overlap) & (t < tbounds[i+1] + 0.5 * overlap)
+        inseg[cores[i]] = True
+        segments.append(np.where(inseg)[0])
+
+    def _detrend(iseg):
+        args_segment = (lc.iloc[iseg].copy(),) + args[1:]
+        return detrend_t_roll_2D(*args_segment,**kwargs)
+
+    if processes==1:
+        lc_segments = map(_detrend, segments)
+    else:
+        pool = ThreadPool(processes)
+        lc_segments = pool.map(_detrend, segments)
+        pool.close()
+        pool.join()
+
+    lc_out = []
+    for core, iseg, lc_segment in zip(cores, segments, lc_segments):
+        lc_out.append(lc_segment.iloc[np.searchsorted(iseg, core)])
     lc_out = pd.concat(lc_out)
-    return lc_out
+    if overlap==0:
+        return lc_out
 
+    # Cross-fade the trends. The weight of each segment falls from 1
+    # to 0 across an overlap-wide window centered on its boundaries
+    fadekeys = [
+        'ftnd_t_roll_2D', 'fdt_t_roll_2D', 'ftnd_t_rollmed', 'fdt_t_rollmed'
+        ]
+    if 'ftnd_t_roll_2D_err' in lc_out.columns:
+        fadekeys.append('ftnd_t_roll_2D_err')
 
+    fsum = np.zeros((len(lc), len(fadekeys)))
+    wsum = np.zeros(len(lc))
+    for i, (iseg, lc_segment) in enumerate(zip(segments, lc_segments)):
+        tseg = t[iseg]
+        w = np.minimum(
+            (tseg - tbounds[i]) / overlap + 0.5, 
+            (tbounds[i+1] - tseg) / overlap + 0.5
+            )
+        w = np.clip(w, 0, 1)
+        fsum[iseg] += w[:,np.newaxis] * np.array(lc_segment[fadekeys])
+        wsum[iseg] += w
 
+    for j, k in enumerate(fadekeys):
+        lc_out[k] = fsum[:,j] / wsum
 
+    return lc_out
@@ -0,0 +1,103 @@
+"""
+Subpixel image registration
+
+Efficient subpixel registration by upsampled cross-correlation
+(Guizar-Sicairos, Thurman & Fienup 2008, Opt. Lett. 33, 156). The
+cross-correlation is computed with FFTs to find the integer-pixel
+peak, then refined with a matrix-multiply DFT evaluated only in a
+1.5 x 1.5 pixel neighbourhood of the peak, upsampled by `usfac`.
+
+All functions work on stacks of images, so many frames (or stamps of
+the same shape) are registered with a handful of array operations.
+"""
+import numpy as np
+
+def upsampled_dft(data, region_size, usfac, offsets):
+    """
+    Upsampled DFT in a small region
+
+    Evaluates the inverse DFT of `data` on a region_size x
+    region_size grid with spacing 1/usfac pixels, starting at
+    `offsets` (in upsampled pixels), by matrix multiplication.
+
+    Parameters
+    ----------
+    data : nimage x nrow x ncol array in the Fourier domain
+    region_size : size of the output region [upsampled pixels]
+    usfac : upsampling factor
+    offsets : nimage x 2 array of (row, col) offsets of the region
+
+    Returns
+    -------
+    out : nimage x region_size x region_size array
+    """
+    nimage, nrow, ncol = data.shape
+    upix = np.arange(region_size)[np.newaxis,:,np.newaxis]
+
+    freq = np.fft.fftfreq(ncol, usfac)[np.newaxis,np.newaxis,:]
+    kernel = np.exp(-2j * np.pi * (upix - offsets[:,1,None,None]) * freq)
+    out = np.matmul(data, kernel.transpose(0,2,1))
+
+    freq = np.fft.fftfreq(nrow, usfac)[np.newaxis,np.newaxis,:]
+    kernel = np.exp(-2j * np.pi * (upix - offsets[:,0,None,None]) * freq)
+    out = np.matmul(kernel, out)
+    return out
+
+def register_images(im1, im2, usfac=100):
+    """
+    Shift between two images (or two stacks of images)
+
+    Parameters
+    ----------
+    im1 : reference image, nrow x ncol or nimage x nrow x ncol
+    im2 : image(s) to register, same shape as im1
+    usfac : upsampling factor. Shifts are found to 1/usfac pixels
+
+    Returns
+    -------
+    dx : shift of im2 relative to im1 along x (column) axis [pixels].
+         im2(x, y) ~ im1(x - dx, y - dy)
+    dy : same along y (row) axis. dx and dy are floats for 2D input
+         and length nimage arrays for 3D input
+    """
+    im1 = np.asarray(im1, dtype=float)
+    im2 = np.asarray(im2, dtype=float)
+    assert im1.shape==im2.shape, "images must have the same shape"
+    single = im1.ndim==2
+    if single:
+        im1 = im1[np.newaxis]
+        im2 = im2[np.newaxis]
+
+    # Missing pixels do not contribute to the correlation
+    im1 = np.where(np.isfinite(im1), im1, 0)
+    im2 = np.where(np.isfinite(im2), im2, 0)
+
+    nimage, nrow, ncol = im1.shape
+    product = np.fft.fft2(im1) * np.fft.fft2(im2).conj()
+
+    # Integer shift from the peak of the cross-correlation
+    cc = np.abs(np.fft.ifft2(product)).reshape(nimage,-1)
+    shifts = np.array(np.unravel_index(np.argmax(cc, axis=1), (nrow,ncol)))
+    shifts = shifts.T.astype(float) # nimage x 2 (row, col)
+    size = np.array([nrow, ncol])
+    wrap = shifts > size // 2
+    shifts[wrap] -= np.repeat(size[np.newaxis], nimage, axis=0)[wrap]
+
+    # Refine in a 1.5 x 1.5 pixel region around the peak
+    if usfac > 1:
+        shifts = np.round(shifts * usfac) / usfac
+        region_size = int(np.ceil(usfac * 1.5))
+        dftshift = np.fix(region_size / 2.0)
+        offsets = dftshift - shifts * usfac
+        cc = upsampled_dft(product.conj(), region_size, usfac, offsets)
+        cc = np.abs(cc).reshape(nimage,-1)
+        peak = np.unravel_index(np.argmax(cc, axis=1), (region_size,)*2)
+        shifts += (np.array(peak).T - dftshift) / usfac
+
+    # shifts moves im2 onto im1, so im2 is im1 shifted by -shifts
+    dy = -shifts[:,0]
+    dx = -shifts[:,1]
+    if single:
+        return dx[0], dy[0]
+
+    return dx, dy
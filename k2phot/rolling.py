@@ -0,0 +1,119 @@
+"""
+Rolling statistics of time series
+
+Running medians are used to find thruster fires and background
+outliers. scipy.ndimage.median_filter sorts every window, which costs
+O(n * size). Here the window is kept in a skiplist (through pandas),
+so the cost is O(n log size).
+"""
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import ndimage as nd
+
+# Below this window size scipy's median_filter is faster than the
+# skiplist (see `benchmark`)
+min_size_skiplist = 25
+
+def rolling_median(x, size):
+    """
+    Running median
+
+    Same output as scipy.ndimage.median_filter(x, size) for 1D
+    arrays: the window of element i starts at i - size//2, the array
+    is reflected at the edges (repeatedly, if the window is longer
+    than the array), and for even sizes the upper of the two middle
+    values is returned. nan values are ignored. When the window is
+    much longer than the array, median_filter (scipy 1.2) does not
+    keep reflecting and its output differs from this one, which
+    matches a brute-force median of the repeatedly reflected array.
+
+    Windows shorter than min_size_skiplist on arrays without nan use
+    median_filter directly, since sorting a short window is cheaper
+    than maintaining the skiplist.
+
+    Parameters
+    ----------
+    x : 1D array
+    size : length of the window
+
+    Returns
+    -------
+    med : array with the same length as x
+    """
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    if n==0:
+        return x.copy()
+
+    if size < min_size_skiplist and n >= size and not np.isnan(x).any():
+        return nd.median_filter(x, size)
+
+    left = size // 2
+    right = size - 1 - left
+
+    # Indices of the padded array, reflected about the edges with
+    # period 2n (x[n-1], ..., x[0] | x[0], ..., x[n-1] | x[n-1], ...)
+    idx = np.arange(-left, n + right) % (2 * n)
+    idx = np.where(idx >= n, 2 * n - 1 - idx, idx)
+    xpad = x[idx]
+    med = pd.Series(xpad).rolling(size, min_periods=1).quantile(
+        0.5, interpolation='higher'
+        )
+    med = np.array(med)[size - 1:]
+    return med
+
+def rolling_mad(x, size, medsize=None):
+    """
+    Running median absolute deviation
+
+    Parameters
+    ----------
+    x : 1D array
+    size : length of the window used to compute the MAD
+    medsize : length of the window used to compute the running median
+              that is subtracted from x. Default: size
+
+    Returns
+    -------
+    absdev : absolute deviation of x from its running median
+    mad : running median of absdev
+    """
+    if medsize is None:
+        medsize = size
+
+    absdev = np.abs(x - rolling_median(x, medsize))
+    mad = rolling_median(absdev, size)
+    return absdev, mad
+
+def benchmark(lengths=[1e3,1e4,1e5,1e6], sizes=[10,100], seed=0):
+    """
+    Compare rolling_median with scipy.ndimage.median_filter
+
+    Returns
+    -------
+    bench : DataFrame with the run time of both implementations [s]
+            for every series length and window size
+    """
+    np.random.seed(seed)
+    bench = []
+    for n in lengths:
+        x = np.random.randn(int(n))
+        for size in sizes:
+            start = time.time()
+            med = rolling_median(x, size)
+            t_rolling = time.time() - start
+
+            start = time.time()
+            med_scipy = nd.median_filter(x, size)
+            t_scipy = time.time() - start
+
+            assert np.allclose(med, med_scipy), "results differ"
+            bench.append(
+                dict(n=int(n), size=size, rolling=t_rolling, scipy=t_scipy)
+                )
+
+    bench = pd.DataFrame(bench)[['n','size','rolling','scipy']]
+    bench['speedup'] = bench['scipy'] / bench['rolling']
+    return bench
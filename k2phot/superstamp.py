@@ -0,0 +1,274 @@
+"""
+Photometry of many stars in cluster superstamps
+
+Clusters (e.g. M35, M67, Lagoon) are observed as superstamps: mosaics
+of many target pixel files that together hold hundreds of stars. The
+regular pipeline assumes one star per pixel file. Here we assemble the
+mosaic once, split it into overlapping tiles, and compute background,
+apertures, and simple aperture photometry for every catalog star in a
+tile. Tiles are processed in parallel and share the mosaic in memory.
+"""
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+from astropy import wcs
+
+import apertures
+from config import bjd0
+
+# Quality bits that remove a cadence. Same as io_utils.pixel.loadPixelFile
+rembits = [1,2,3,4,5,6,7,8,9,11]
+
+# Mosaic shared with the worker processes. Set before the pool is
+# created so that forked workers see it without copying.
+_MOSAIC = None
+
+class SuperStamp(object):
+    """
+    Superstamp mosaic
+
+    :param pixfns: paths to the pixel files making up the superstamp.
+        Must be from the same campaign and channel.
+    :type pixfns: list of str
+
+    :param tlimits: [optional] read in only a segment of data. Same
+        convention as ImageStack
+    :type tlimits: 2 element list
+    """
+    def __init__(self, pixfns, tlimits=[-np.inf,np.inf]):
+        self.pixfns = pixfns
+
+        # Chip coordinates of each stamp. 1CRV4P (2CRV4P) is the
+        # column (row) of flux[:,0,0] counting from 1.
+        stamps = []
+        for pixfn in pixfns:
+            with fits.open(pixfn) as hduL:
+                nrow, ncol = hduL[1].data['FLUX'].shape[1:]
+                stamps.append(dict(
+                    pixfn=pixfn, col=hduL[1].header['1CRV4P'],
+                    row=hduL[1].header['2CRV4P'], nrow=nrow, ncol=ncol,
+                    ))
+
+        stamps = pd.DataFrame(stamps)
+        self.col0 = stamps.col.min()
+        self.row0 = stamps.row.min()
+        stamps['x0'] = stamps.col - self.col0
+        stamps['y0'] = stamps.row - self.row0
+        self.nrow = (stamps.y0 + stamps.nrow).max()
+        self.ncol = (stamps.x0 + stamps.ncol).max()
+        self.stamps = stamps
+
+        # Cadences and quality mask come from the first file
+        with fits.open(pixfns[0]) as hduL:
+            cube = hduL[1].data
+            t = np.array(cube['TIME'])
+            cad = np.array(cube['CADENCENO'])
+            quality = np.array(cube['QUALITY'])
+
+        qmask = np.sum([2**(bit - 1) for bit in rembits])
+        b = ((quality & qmask)==0) & (t > tlimits[0]) & (t < tlimits[1])
+        b = b & np.isfinite(t)
+        self.t = t[b] + bjd0
+        self.cad = cad[b]
+        self.nframe = len(self.cad)
+
+        # Read every pixel file exactly once
+        flux = np.empty((self.nframe, self.nrow, self.ncol), dtype=np.float32)
+        flux.fill(np.nan)
+        for i, stamp in stamps.iterrows():
+            with fits.open(stamp['pixfn']) as hduL:
+                _flux = hduL[1].data['FLUX']
+                assert len(_flux)==len(b), "cadences differ between files"
+                rows = slice(stamp['y0'], stamp['y0'] + stamp['nrow'])
+                cols = slice(stamp['x0'], stamp['x0'] + stamp['ncol'])
+                flux[:,rows,cols] = _flux[b]
+
+        self.flux = flux
+        print "superstamp: {} files, {} x {} pixels, {} cadences".format(
+            len(stamps), self.nrow, self.ncol, self.nframe)
+
+    def get_star_positions(self, cat):
+        """
+        Position of catalog stars in mosaic pixel coordinates
+
+        The WCS of each pixel file is only accurate near that file, so
+        each star is placed with the WCS of the file whose center is
+        closest.
+
+        Parameters
+        ----------
+        cat : DataFrame with epic, ra, dec, and kepmag columns
+
+        Returns
+        -------
+        stars : copy of cat with x, y (mosaic column, row) columns,
+                restricted to stars that fall on valid pixels
+        """
+        stars = cat.copy()
+        ra, dec = np.array(stars.ra), np.array(stars.dec)
+        xL, yL = [], []
+        for i, stamp in self.stamps.iterrows():
+            with fits.open(stamp['pixfn']) as hduL:
+                w = wcs.WCS(header=hduL[2].header,key=' ')
+            x, y = w.wcs_world2pix(ra, dec, 0)
+            xL.append(x + stamp['x0'])
+            yL.append(y + stamp['y0'])
+
+        xL, yL = np.array(xL), np.array(yL)
+        xcen = np.array(self.stamps.x0 + 0.5 * (self.stamps.ncol - 1))
+        ycen = np.array(self.stamps.y0 + 0.5 * (self.stamps.nrow - 1))
+        dist = (xL - xcen[:,np.newaxis])**2 + (yL - ycen[:,np.newaxis])**2
+        istamp = np.argmin(dist, axis=0)
+        istar = np.arange(len(stars))
+        stars['x'] = xL[istamp,istar]
+        stars['y'] = yL[istamp,istar]
+
+        # Keep stars that land on pixels with data
+        col = np.round(stars.x).astype(int)
+        row = np.round(stars.y).astype(int)
+        b = (col >= 0) & (col < self.ncol) & (row >= 0) & (row < self.nrow)
+        stars = stars[b]
+        col, row = np.array(col[b]), np.array(row[b])
+        valid = np.isfinite(self.flux[self.nframe // 2])
+        stars = stars[valid[row,col]]
+        return stars
+
+    def get_tiles(self, stars, tile_size=64, overlap=8):
+        """
+        Split the mosaic into overlapping tiles
+
+        Each star belongs to the tile whose core contains it. Tiles
+        extend `overlap` pixels beyond their core on all sides, so
+        apertures of stars near the core edge fit in the tile.
+
+        Returns
+        -------
+        tiles : list of dictionaries with row and column slices of
+                the mosaic and the stars in the tile
+        """
+        tiles = []
+        stars = stars.copy()
+        stars['tilerow'] = (np.round(stars.y) // tile_size).astype(int)
+        stars['tilecol'] = (np.round(stars.x) // tile_size).astype(int)
+        for (tilerow, tilecol), _stars in stars.groupby(['tilerow','tilecol']):
+            r0 = max(tilerow * tile_size - overlap, 0)
+            r1 = min((tilerow + 1) * tile_size + overlap, self.nrow)
+            c0 = max(tilecol * tile_size - overlap, 0)
+            c1 = min((tilecol + 1) * tile_size + overlap, self.ncol)
+            tiles.append(dict(
+                rows=slice(r0, r1), cols=slice(c0, c1), stars=_stars,
+                ))
+
+        return tiles
+
+    def photometry(self, cat, tile_size=64, overlap=8, processes=None):
+        """
+        Simple aperture photometry of every catalog star
+
+        Parameters
+        ----------
+        cat : DataFrame with epic, ra, dec, and kepmag columns. An
+              optional npix column sets the aperture size, otherwise
+              it is estimated from kepmag
+        tile_size : size of tile cores [pixels]
+        overlap : pixels added to each side of a tile core. Increased
+                  if needed to fit the largest aperture (see
+                  `aperture_half_width`)
+        processes : number of worker processes. Default: all cores
+
+        Returns
+        -------
+        stars : DataFrame with position and aperture size of each star
+        fsap : DataFrame (ncad x nstar) background-subtracted aperture
+               flux. Indexed by cadence, columns are epic ids
+        fbg : DataFrame (ncad x nstar) background flux per pixel
+        """
+        global _MOSAIC
+
+        stars = self.get_star_positions(cat)
+        if 'npix' not in stars.columns:
+            from pipeline_core import kepmag_to_npix
+            stars['npix'] = np.round(kepmag_to_npix(np.array(stars.kepmag)))
+
+        half = max(aperture_half_width(npix) for npix in stars.npix)
+        if overlap < half:
+            print "increasing tile overlap from {} to {} pixels".format(
+                overlap, half)
+            overlap = half
+
+        tiles = self.get_tiles(stars, tile_size=tile_size, overlap=overlap)
+        print "{} stars in {} tiles".format(len(stars), len(tiles))
+
+        _MOSAIC = self.flux
+        pool = Pool(processes=processes)
+        try:
+            out = pool.map(_tile_photometry, tiles)
+        finally:
+            pool.close()
+            pool.join()
+            _MOSAIC = None
+
+        stars = pd.concat([_out[0] for _out in out])
+        fsap = np.hstack([_out[1] for _out in out])
+        fbg = np.hstack([_out[2] for _out in out])
+        fsap = pd.DataFrame(fsap, index=self.cad, columns=stars.epic)
+        fbg = pd.DataFrame(fbg, index=self.cad, columns=stars.epic)
+        fsap.index.name = 'cad'
+        fbg.index.name = 'cad'
+        return stars, fsap, fbg
+
+def aperture_half_width(npix):
+    """
+    Half width of the cutout a region aperture of npix pixels is built
+    on. Tiles must overlap by at least this much so that apertures of
+    stars at the edge of a tile core are not clipped.
+    """
+    return int(np.ceil(np.sqrt(npix))) + 2
+
+def _tile_photometry(tile):
+    """
+    Background, apertures, and photometry for all stars in one tile
+
+    Runs in a worker process and reads the shared mosaic.
+    """
+    flux = _MOSAIC[:,tile['rows'],tile['cols']].astype(float)
+    nframe, nrow, ncol = flux.shape
+    stars = tile['stars'].copy()
+    stars['x'] -= tile['cols'].start
+    stars['y'] -= tile['rows'].start
+
+    # As in Pipeline, build apertures on the 99th percentile image
+    ap_im = np.nanpercentile(flux, 99.0, 0)
+    ap_im[~np.isfinite(ap_im)] = 0
+
+    # Region apertures grow pixel by pixel over the whole input image,
+    # so build them on a cutout just large enough for the aperture
+    weights = np.zeros((len(stars), nrow, ncol))
+    for i, (_, star) in enumerate(stars.iterrows()):
+        half = aperture_half_width(star['npix'])
+        col, row = int(np.round(star['x'])), int(np.round(star['y']))
+        r0, r1 = max(row - half, 0), min(row + half + 1, nrow)
+        c0, c1 = max(col - half, 0), min(col + half + 1, ncol)
+        _ap = apertures.region_aperture(
+            ap_im[r0:r1,c0:c1], col - c0, row - r0, star['npix']
+            )
+        weights[i,r0:r1,c0:c1] = _ap.weights
+
+    weights = weights.reshape(len(stars),-1) # nstar x npix
+
+    # Background from pixels outside every aperture in the tile
+    flux = flux.reshape(nframe,-1)
+    bgpix = flux[:,weights.sum(axis=0)==0]
+    fbg = np.nanmedian(bgpix, axis=1)
+    fbg = np.repeat(fbg[:,np.newaxis], len(stars), axis=1)
+
+    # Photometry for all stars at once
+    flux = flux - fbg[:,:1]
+    flux[~np.isfinite(flux)] = 0
+    fsap = np.dot(flux, weights.T) # nframe x nstar
+
+    stars['x'] += tile['cols'].start
+    stars['y'] += tile['rows'].start
+    return stars, fsap, fbg
@@ -0,0 +1,157 @@
+"""
+Synthetic images of stars
+
+Renders catalog stars into a pixel stamp. Used to estimate crowding
+and contamination of apertures, and to register the WCS.
+"""
+import numpy as np
+from scipy.special import erf
+
+# Flux of a Kp = 12 star in electrons per second
+flux12 = 1.74e5
+
+def kepmag_to_flux(kepmag):
+    """Convert Kepler magnitude into flux [electrons per second]"""
+    return flux12 * 10**(-0.4 * (np.asarray(kepmag) - 12))
+
+def gaussian_profile(npix, cen, sigma):
+    """
+    Fraction of a 1D Gaussian falling in each pixel
+
+    Parameters
+    ----------
+    npix : number of pixels along the axis
+    cen : length nstar array of centers. Pixel i spans i-0.5 to i+0.5
+    sigma : width of the Gaussian [pixels]
+
+    Returns
+    -------
+    profile : nstar x npix array
+    """
+    cen = np.atleast_1d(np.asarray(cen, dtype=float))[:,np.newaxis]
+    edges = np.arange(npix + 1) - 0.5
+    cdf = 0.5 * erf((edges[np.newaxis,:] - cen) / (np.sqrt(2) * sigma))
+    profile = cdf[:,1:] - cdf[:,:-1]
+    return profile
+
+def render_stars(shape, x, y, flux, sigma=0.5, stack=False):
+    """
+    Render stars as pixel-integrated Gaussians
+
+    All stars are evaluated in one broadcasted operation. A Gaussian
+    is separable, so each star is the outer product of a row and a
+    column profile.
+
+    Parameters
+    ----------
+    shape : (nrow, ncol) of the stamp
+    x : length nstar array. Column position of stars
+    y : length nstar array. Row position of stars
+    flux : length nstar array. Total flux of each star
+    sigma : width of the PSF [pixels]
+    stack : if True, return the image of each star separately
+
+    Returns
+    -------
+    image : nrow x ncol image, or nstar x nrow x ncol if stack is True
+    """
+    nrow, ncol = shape
+    flux = np.atleast_1d(np.asarray(flux, dtype=float))
+    profx = gaussian_profile(ncol, x, sigma) # nstar x ncol
+    profy = gaussian_profile(nrow, y, sigma) * flux[:,np.newaxis]
+    if stack:
+        return profy[:,:,np.newaxis] * profx[:,np.newaxis,:]
+
+    return np.dot(profy.T, profx)
+
+def prf_stamps(prf, sampling):
+    """
+    Pixel-integrated PRF at every subpixel phase
+
+    The Kepler PRF is tabulated on a grid `sampling` times finer than
+    the detector pixels. Binning it to pixels for every star is slow,
+    so we bin it once for each of the sampling x sampling subpixel
+    positions of the star, using an integral image.
+
+    Parameters
+    ----------
+    prf : supersampled PRF (see `io_utils.pixel.loadPRF`). The star is
+          at the peak
+    sampling : number of PRF samples per pixel
+
+    Returns
+    -------
+    stamps : sampling x sampling x nrow x ncol array. stamps[py,px]
+             is the PRF of a star py/sampling (px/sampling) pixels
+             beyond the center of a pixel along the row (column)
+             axis. Normalized to unit sum
+    i0, j0 : row, column offset of stamps[py,px,0,0] relative to that
+             pixel
+    """
+    prf = np.asarray(prf, dtype=float)
+    prf = prf / prf.sum()
+    s = int(sampling)
+    mrow, mcol = np.unravel_index(np.argmax(prf), prf.shape)
+
+    # Integral image with a leading row and column of zeros
+    S = np.zeros((prf.shape[0] + 1, prf.shape[1] + 1))
+    S[1:,1:] = prf.cumsum(axis=0).cumsum(axis=1)
+
+    def edges(n, m):
+        # Supersampled sample k belongs to pixel floor((k + p - m + s//2) / s)
+        p = np.arange(s)[:,np.newaxis]
+        j = np.arange(
+            (-m + s//2) // s, (n - 1 + s - 1 - m + s//2) // s + 1
+            )
+        lo = np.clip(j * s - p + m - s//2, 0, n)
+        hi = np.clip((j + 1) * s - p + m - s//2, 0, n)
+        return lo, hi, j[0]
+
+    lor, hir, i0 = edges(prf.shape[0], mrow)
+    loc, hic, j0 = edges(prf.shape[1], mcol)
+    lor, hir = lor[:,np.newaxis,:,np.newaxis], hir[:,np.newaxis,:,np.newaxis]
+    loc, hic = loc[np.newaxis,:,np.newaxis,:], hic[np.newaxis,:,np.newaxis,:]
+    stamps = S[hir,hic] - S[lor,hic] - S[hir,loc] + S[lor,loc]
+    return stamps, i0, j0
+
+def render_prf(shape, x, y, flux, stamps):
+    """
+    Render stars by scattering pixel-integrated PRF stamps
+
+    Parameters
+    ----------
+    shape : (nrow, ncol) of the image
+    x : length nstar array. Column position of stars
+    y : length nstar array. Row position of stars
+    flux : length nstar array. Total flux of each star
+    stamps : output of `prf_stamps`
+
+    Returns
+    -------
+    image : nrow x ncol image
+    """
+    stamps, i0, j0 = stamps
+    s = stamps.shape[0]
+    nrow, ncol = shape
+    x = np.atleast_1d(np.asarray(x, dtype=float))
+    y = np.atleast_1d(np.asarray(y, dtype=float))
+    flux = np.atleast_1d(np.asarray(flux, dtype=float))
+
+    # Star is at integer position c plus phase p / s, 0 <= p < s
+    col = np.floor(x).astype(int)
+    row = np.floor(y).astype(int)
+    pcol = np.round((x - col) * s).astype(int)
+    prow = np.round((y - row) * s).astype(int)
+    col, pcol = col + pcol // s, pcol % s
+    row, prow = row + prow // s, prow % s
+
+    nsr, nsc = stamps.shape[2:]
+    irow = row[:,np.newaxis,np.newaxis] + i0 + np.arange(nsr)[:,np.newaxis]
+    icol = col[:,np.newaxis,np.newaxis] + j0 + np.arange(nsc)[np.newaxis,:]
+    vals = stamps[prow,pcol] * flux[:,np.newaxis,np.newaxis]
+    irow, icol = np.broadcast_arrays(irow, icol)
+    b = (irow >= 0) & (irow < nrow) & (icol >= 0) & (icol < ncol)
+
+    image = np.zeros(shape)
+    np.add.at(image, (irow[b], icol[b]), vals[b])
+    return image
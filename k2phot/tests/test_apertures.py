@@ -0,0 +1,56 @@
+import numpy as np
+from ..apertures import mask_to_verts, _polygon_area, CompactWeights
+
+def test_mask_to_verts_rectangle():
+    mask = np.zeros((6,8))
+    mask[2:4,1:6] = 1 # rows 2-3, columns 1-5
+    verts = mask_to_verts(mask)
+
+    # Four corners plus the repeated first vertex
+    assert verts.shape==(5,2)
+    assert np.all(verts[0]==verts[-1])
+    assert np.allclose(verts[:,0].min(), 0.5)
+    assert np.allclose(verts[:,0].max(), 5.5)
+    assert np.allclose(verts[:,1].min(), 1.5)
+    assert np.allclose(verts[:,1].max(), 3.5)
+    assert np.allclose(_polygon_area(verts[:-1]), mask.sum())
+
+def test_mask_to_verts_L():
+    mask = np.zeros((5,5))
+    mask[1:4,1] = 1
+    mask[3,1:4] = 1
+    verts = mask_to_verts(mask)
+
+    # An L has six corners
+    assert len(verts)==7
+    assert np.allclose(_polygon_area(verts[:-1]), mask.sum())
+
+def test_mask_to_verts_hole():
+    mask = np.zeros((5,5))
+    mask[1:4,1:4] = 1
+    mask[2,2] = 0
+    verts = mask_to_verts(mask)
+
+    # The outline is the outer boundary, the hole is ignored
+    assert len(verts)==5
+    assert np.allclose(_polygon_area(verts[:-1]), 9)
+
+def test_mask_to_verts_empty():
+    verts = mask_to_verts(np.zeros((3,3)))
+    assert verts.shape==(0,2)
+
+def test_compact_weights_bitpack():
+    weights = np.zeros((7,9))
+    weights[2:5,3:7] = 1
+    cw = CompactWeights(weights)
+    assert cw.encoding=='bitpack'
+    assert np.all(cw.to_dense()==weights)
+
+def test_compact_weights_sparse():
+    np.random.seed(0)
+    weights = np.zeros((7,9))
+    weights[2:5,3:7] = np.random.uniform(0.1, 2, size=(3,4))
+    cw = CompactWeights(weights)
+    assert cw.encoding=='sparse'
+    assert len(cw.data)==12
+    assert np.all(cw.to_dense()==weights)
@@ -14,3 +14,39 @@ h5file = os.path.join(K2_DIR,"test_channel_trans_C1_ch04.h5")
 
 def test_channel_transform():
     channel_transform(fitsfiles, h5file, iref= None)
+
+def test_select_channel_stars(tmpdir):
+    import sqlite3
+    import numpy as np
+    import pandas as pd
+    from ..channel_transform import select_channel_stars
+
+    # 4 x 4 stars spread over one channel. NAXIS1/NAXIS2 are the
+    # binary table dimensions and must not affect the selection
+    np.random.seed(0)
+    headers = []
+    npix = []
+    for i in range(16):
+        nrow, ncol = np.random.randint(5, 30, size=2)
+        npix.append(nrow * ncol)
+        headers.append(dict(
+            fitsfile='star%02i.fits' % i, CHANNEL=4, CAMPAIGN=1,
+            NAXIS1=np.random.randint(1000,10000), 
+            NAXIS2=np.random.randint(1000,4000),
+            TDIM4='(%i,%i)' % (ncol, nrow),
+            REF_ROW=50 + 250 * (i // 4), REF_COL=30 + 250 * (i % 4),
+        ))
+
+    headers = pd.DataFrame(headers)
+    dbfile = str(tmpdir.join('headers.db'))
+    con = sqlite3.connect(dbfile)
+    headers.to_sql('headers', con, index=False)
+    con.close()
+    headers['npix'] = npix
+
+    # One star from each quadrant, the smallest stamp in each
+    stars = select_channel_stars(dbfile, nstars=4, ngrid=2)
+    i = np.arange(16)
+    headers['quadrant'] = 2 * (i // 8) + (i % 4) // 2
+    expected = headers.sort_values(by='npix').groupby('quadrant').first()
+    assert sorted(stars.fitsfile)==sorted(expected.fitsfile)
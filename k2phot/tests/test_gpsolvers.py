@@ -0,0 +1,90 @@
+import numpy as np
+from ..gpsolvers import get_solver
+
+def _mock_lc(n=300):
+    np.random.seed(0)
+    t = np.linspace(0, 10, n)
+    roll = np.sin(3 * t) + np.random.normal(0, 0.1, n)
+    X = np.vstack([t, roll]).T
+    y = 1e-3 * (np.sin(t) + roll) + np.random.normal(0, 1e-4, n)
+    return X, y
+
+def _refit(X, y, mask, solver='dense'):
+    """Predictions of a solver factorized without the masked points"""
+    gp = get_solver(solver, 1e-3, 2.0, 0.5)
+    gp.compute(X[~mask], 1e-4)
+    return gp.predict(y[~mask], X, return_var=True)
+
+def test_dense_downdate():
+    X, y = _mock_lc()
+    gp = get_solver('dense', 1e-3, 2.0, 0.5)
+    gp.compute(X, 1e-4)
+
+    # Remove points in two steps, staying below downdate_max_frac so
+    # the factorization is downdated rather than recomputed
+    mask = np.zeros(len(X), dtype=bool)
+    mask[[10, 50, 51, 200]] = True
+    gp.downdate(mask)
+    mask[[120, 121, 122]] = True
+    gp.downdate(mask)
+    assert len(gp.ikeep)==len(X)
+
+    mu, var = gp.predict(y, X, return_var=True)
+    _mu, _var = _refit(X, y, mask)
+    assert np.allclose(mu, _mu, rtol=0, atol=1e-8)
+    assert np.allclose(var, _var, rtol=0, atol=1e-12)
+
+def test_dense_downdate_refactor():
+    X, y = _mock_lc()
+    gp = get_solver('dense', 1e-3, 2.0, 0.5)
+    gp.compute(X, 1e-4)
+
+    mask = np.zeros(len(X), dtype=bool)
+    mask[100:160] = True
+    gp.downdate(mask)
+    assert len(gp.ikeep)==len(X) - 60
+
+    mu = gp.predict(y, X)
+    _mu, _var = _refit(X, y, mask)
+    assert np.allclose(mu, _mu, rtol=0, atol=1e-8)
+
+def test_dense_downdate_disjoint_masks():
+    X, y = _mock_lc()
+    gp = get_solver('dense', 1e-3, 2.0, 0.5)
+    gp.compute(X, 1e-4)
+
+    # Masks that do not repeat the points removed earlier. The first is
+    # downdated, the second is over downdate_max_frac, so the solver
+    # refactorizes and must still leave out the first set of points
+    mask1 = np.zeros(len(X), dtype=bool)
+    mask1[20:40] = True
+    mask2 = np.zeros(len(X), dtype=bool)
+    mask2[200:240] = True
+    mask3 = np.zeros(len(X), dtype=bool)
+    mask3[[100, 101]] = True
+    for mask in [mask1, mask2, mask3]:
+        gp.downdate(mask)
+
+    mu, var = gp.predict(y, X, return_var=True)
+    _mu, _var = _refit(X, y, mask1 | mask2 | mask3)
+    assert np.allclose(mu, _mu, rtol=0, atol=1e-8)
+    assert np.allclose(var, _var, rtol=0, atol=1e-12)
+
+def test_dense_downdate_threshold():
+    X, y = _mock_lc()
+    gp = get_solver('dense', 1e-3, 2.0, 0.5)
+    gp.compute(X, 1e-4)
+
+    # Each mask is under downdate_max_frac, together they are over it
+    mask1 = np.zeros(len(X), dtype=bool)
+    mask1[20:40] = True
+    mask2 = np.zeros(len(X), dtype=bool)
+    mask2[200:220] = True
+    gp.downdate(mask1)
+    assert len(gp.ikeep)==len(X)
+    gp.downdate(mask2)
+    assert len(gp.ikeep)==len(X) - 40
+
+    mu = gp.predict(y, X)
+    _mu, _var = _refit(X, y, mask1 | mask2)
+    assert np.allclose(mu, _mu, rtol=0, atol=1e-8)
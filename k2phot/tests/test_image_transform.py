@@ -0,0 +1,54 @@
+import numpy as np
+from ..image_transform import (
+    fit_6_par_trans, trans_suffstats, add_suffstats, fit_6_par_trans_suffstats
+)
+
+def _mock_positions(nstar=20, nframe=5):
+    np.random.seed(0)
+    x1 = np.random.uniform(0, 50, nstar)
+    y1 = np.random.uniform(0, 50, nstar)
+    x2 = np.empty((nstar,nframe))
+    y2 = np.empty((nstar,nframe))
+    for i in range(nframe):
+        TM = np.eye(2) + np.random.normal(0, 1e-3, size=(2,2))
+        shift = np.random.normal(0, 0.5, size=2)
+        x2[:,i] = TM[0,0] * x1 + TM[0,1] * y1 + shift[0]
+        y2[:,i] = TM[1,0] * x1 + TM[1,1] * y1 + shift[1]
+
+    x2 += np.random.normal(0, 0.01, size=x2.shape)
+    y2 += np.random.normal(0, 0.01, size=y2.shape)
+    return x1, y1, x2, y2
+
+def test_fit_6_par_trans_suffstats():
+    x1, y1, x2, y2 = _mock_positions()
+    TM, x1o, y1o, x2o, y2o = fit_6_par_trans_suffstats(
+        trans_suffstats(x1, y1, x2, y2)
+    )
+    for i in range(x2.shape[1]):
+        _TM, _x1o, _y1o, _x2o, _y2o = fit_6_par_trans(x1, y1, x2[:,i], y2[:,i])
+        assert np.allclose(TM[i], _TM)
+        assert np.allclose([x1o[i], y1o[i], x2o[i], y2o[i]],
+                           [_x1o, _y1o, _x2o, _y2o])
+
+def test_add_suffstats():
+    x1, y1, x2, y2 = _mock_positions()
+    stats = add_suffstats(
+        trans_suffstats(x1[:8], y1[:8], x2[:8], y2[:8]),
+        trans_suffstats(x1[8:], y1[8:], x2[8:], y2[8:]),
+    )
+    TM = fit_6_par_trans_suffstats(stats)[0]
+    _TM = fit_6_par_trans_suffstats(trans_suffstats(x1, y1, x2, y2))[0]
+    assert np.allclose(TM, _TM)
+
+def test_fit_6_par_trans_suffstats_mask():
+    x1, y1, x2, y2 = _mock_positions()
+    mask = np.ones(x2.shape, dtype=bool)
+    mask[:3,0] = False
+    x2[3,1] = np.nan
+
+    TM = fit_6_par_trans_suffstats(trans_suffstats(x1, y1, x2, y2, mask))[0]
+    _TM = fit_6_par_trans(x1[3:], y1[3:], x2[3:,0], y2[3:,0])[0]
+    assert np.allclose(TM[0], _TM)
+    b = np.arange(len(x1))!=3
+    _TM = fit_6_par_trans(x1[b], y1[b], x2[b,1], y2[b,1])[0]
+    assert np.allclose(TM[1], _TM)
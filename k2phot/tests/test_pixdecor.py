@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+from ..pixdecor import (
+    detrend_t_roll_2D, detrend_t_roll_2D_multi, detrend_t_roll_2D_segments
+)
+
+def _mock_lc(n=200, nlc=3):
+    np.random.seed(0)
+    t = np.linspace(0, 5, n)
+    roll = np.sin(4 * t) + np.random.normal(0, 0.1, n)
+    lc = pd.DataFrame(dict(t=t, roll=roll))
+    lc['fdtmask'] = False
+    lc.loc[[5, 17, 90], 'fdtmask'] = True
+
+    flux = np.empty((n, nlc))
+    for i in range(nlc):
+        flux[:,i] = 1e-3 * (np.sin(t + i) + (i + 1) * roll)
+    flux += np.random.normal(0, 1e-4, flux.shape)
+    return lc, flux
+
+def test_detrend_t_roll_2D_multi():
+    lc, flux = _mock_lc()
+    hyper = (1e-3, 2.0, 0.5, 1e-4)
+    for solver in ['dense', 'vfe']:
+        dt = detrend_t_roll_2D_multi(lc, flux, *hyper, solver=solver)
+        for i in range(flux.shape[1]):
+            _lc = lc.copy()
+            _lc['f'] = flux[:,i]
+            _lc = detrend_t_roll_2D(_lc, *hyper, solver=solver)
+            for key in dt.keys():
+                assert np.allclose(dt[key][:,i], _lc[key]), (solver, key)
+
+def test_detrend_t_roll_2D_segments_overlap():
+    lc, flux = _mock_lc(n=400)
+    lc['t'] *= 4 # 20 days, two segments
+    lc['f'] = flux[:,0]
+    hyper = (1e-3, 2.0, 0.5, 1e-4)
+    kw = dict(segment_length=10, overlap=2, return_var=True)
+    lc_out = detrend_t_roll_2D_segments(lc.copy(), *hyper, **kw)
+    _lc_out = detrend_t_roll_2D_segments(lc.copy(), *hyper, processes=2, **kw)
+    for key in ['ftnd_t_roll_2D', 'ftnd_t_roll_2D_err']:
+        assert np.allclose(lc_out[key], _lc_out[key])
+
+    # Detrend the two segments separately. In the overlap the
+    # uncertainties are cross-faded like the trends
+    t = np.array(lc.t)
+    tbound = 0.5 * (t[199] + t[200])
+    b0 = t < tbound + 1
+    b1 = t > tbound - 1
+    err0 = np.zeros(len(lc))
+    err1 = np.zeros(len(lc))
+    err0[b0] = detrend_t_roll_2D(lc[b0].copy(), *hyper, return_var=True)[
+        'ftnd_t_roll_2D_err']
+    err1[b1] = detrend_t_roll_2D(lc[b1].copy(), *hyper, return_var=True)[
+        'ftnd_t_roll_2D_err']
+    w1 = np.clip((t - tbound) / 2.0 + 0.5, 0, 1)
+    err = (1 - w1) * err0 + w1 * err1
+    assert np.allclose(lc_out.ftnd_t_roll_2D_err, err, rtol=1e-6, atol=0)
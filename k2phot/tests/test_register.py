@@ -0,0 +1,30 @@
+import numpy as np
+from ..register import register_images
+from ..synthetic import render_stars
+
+def _stars(dx=0, dy=0):
+    np.random.seed(0)
+    x = np.random.uniform(5, 27, 6)
+    y = np.random.uniform(5, 27, 6)
+    flux = np.random.uniform(1, 10, 6)
+    return render_stars((32,32), x + dx, y + dy, flux, sigma=1.5)
+
+def test_register_images_integer():
+    im1 = _stars()
+    im2 = np.roll(np.roll(im1, 3, axis=0), -2, axis=1)
+    dx, dy = register_images(im1, im2)
+    assert np.allclose([dx, dy], [-2, 3])
+
+def test_register_images_subpixel():
+    im1 = _stars()
+    im2 = _stars(0.37, -0.62)
+    dx, dy = register_images(im1, im2)
+    assert np.allclose([dx, dy], [0.37, -0.62], atol=0.02)
+
+def test_register_images_stack():
+    shifts = [(0.1, 0.2), (-0.45, 0.3), (1.25, -0.8)]
+    im1 = np.array([_stars() for s in shifts])
+    im2 = np.array([_stars(*s) for s in shifts])
+    dx, dy = register_images(im1, im2)
+    assert np.allclose(dx, [s[0] for s in shifts], atol=0.02)
+    assert np.allclose(dy, [s[1] for s in shifts], atol=0.02)
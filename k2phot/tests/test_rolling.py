@@ -0,0 +1,37 @@
+import numpy as np
+from scipy import ndimage as nd
+from ..rolling import rolling_median
+
+def test_rolling_median():
+    np.random.seed(0)
+    x = np.random.normal(size=500)
+    x[::37] += 10 # outliers
+    for size in [1, 2, 5, 10, 24, 25, 40, 101]:
+        med = rolling_median(x, size)
+        assert np.allclose(med, nd.median_filter(x, size)), size
+
+def test_rolling_median_short():
+    # Windows longer than the array reflect it repeatedly
+    np.random.seed(1)
+    for n in [1, 2, 3, 7]:
+        x = np.random.normal(size=n)
+        for size in [5, 41]:
+            period = np.hstack([x, x[::-1]])
+            idx = np.arange(-(size // 2), n + size - 1 - size // 2)
+            xpad = period[idx % (2 * n)]
+            expected = [
+                np.sort(xpad[i:i + size])[size // 2] for i in range(n)
+            ]
+            assert np.allclose(rolling_median(x, size), expected), (n, size)
+
+def test_rolling_median_nan():
+    np.random.seed(2)
+    x = np.random.normal(size=200)
+    x[50] = np.nan
+    med = rolling_median(x, 11)
+    assert np.all(np.isfinite(med))
+
+    # Away from the nan the result is unchanged
+    _med = nd.median_filter(np.nan_to_num(x), 11)
+    assert np.allclose(med[:44], _med[:44])
+    assert np.allclose(med[57:], _med[57:])